@@ -1,96 +1,107 @@
-import os
-import requests
-from PIL import Image
-import xml.etree.ElementTree as ET
-from datetime import datetime
-
-
-timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-download_path = os.path.join('E:\\2025', f'download_{timestamp}')
-os.makedirs(download_path, exist_ok=True)
-
-
-# 下载和解析 XML
-dzi = "https://opac.lib.takushoku-u.ac.jp/kyugaichi/htmls/resources/2013_013_001/root.xml"
-response = requests.get(dzi)
-xml_content = response.text
-
-# 打印 XML 内容进行调试
-print("XML 内容：")
-print(xml_content)
-
-root = ET.fromstring(xml_content)
-
-# 获取 <image> 节点并提取信息 ，没有的可以换成resource
-image_node = root.find('.//image')
-if image_node is None:
-    image_node = root.find('.//resource')
-
-if image_node is not None:
-    print("找到节点：", image_node.tag)
-else:
-    print("未找到节点")
-
-if image_node is not None:
-    wi = int(image_node.attrib['width'])
-    hi = int(image_node.attrib['height'])
-    tsize = int(image_node.attrib['tilewidth'])
-else:
-    raise ValueError("XML 文件中未找到 <image> 节点")
-
-# 输出获取的参数
-print(f"Width: {wi}, Height: {hi}, Tile Width: {tsize}")
-
-# 计算列数和行数
-cols = (wi // tsize) + 1
-rows = (hi // tsize) + 1
-
-# 下载图像瓦片并拼接
-if not os.path.exists(download_path):
-    os.makedirs(download_path)
-
-for i in range(rows):
-    string = []
-    for j in range(cols):
-        nh = tsize if i < rows - 1 else hi % tsize or tsize  # 确保至少有一个瓦片
-        nw = tsize if j < cols - 1 else wi % tsize or tsize
-
-        num1 = f"{j * tsize:05d}"
-        num2 = f"{i * tsize:05d}"
-        num3 = f"{nw:05d}"
-        num4 = f"{nh:05d}"
-        image_name = f"{num1}{num2}{num3}{num4}.jpg"
-        img_path = os.path.join(download_path, f"{j}_{i}.jpg")
-        file_url = f"{dzi.replace('root.xml', '0/')}{image_name}"
-
-        print(f"Downloading {file_url}")
-        img_response = requests.get(file_url)
-        if img_response.status_code == 200:
-            with open(img_path, "wb") as f:
-                f.write(img_response.content)
-            string.append(img_path)
-        else:
-            print(f"Failed to download {file_url}. Status code: {img_response.status_code}")
-
-    # 拼接当前行的图像
-    if string:
-        row_image = Image.open(string[0])
-        for img_path in string[1:]:
-            next_image = Image.open(img_path)
-            new_width = row_image.width + next_image.width
-            new_image = Image.new('RGB', (new_width, row_image.height))
-            new_image.paste(row_image, (0, 0))
-            new_image.paste(next_image, (row_image.width, 0))
-            row_image = new_image
-        row_image.save(os.path.join(download_path, f"row{i}.jpg"))
-
-# 最后合并所有行的图像
-final_images = [Image.open(os.path.join(download_path, f"row{i}.jpg")) for i in range(rows)]
-full_image = Image.new('RGB', (wi, hi))
-y_offset = 0
-for img in final_images:
-    full_image.paste(img, (0, y_offset))
-    y_offset += img.height
-
-full_image.save(os.path.join(download_path, "full.jpg"))
-print(f"全图已保存为 {os.path.join(download_path, 'full.jpg')}")
+import os
+from io import BytesIO
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def create_session(max_workers):
+    """创建带连接池的 Session，所有瓦片复用 keep-alive 连接"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def parse_root_xml(session, dzi, timeout):
+    """下载并解析 root.xml，返回 (宽, 高, 瓦片尺寸)"""
+    response = session.get(dzi, timeout=timeout)
+    response.raise_for_status()
+    root = ET.fromstring(response.text)
+
+    # 获取 <image> 节点并提取信息 ，没有的可以换成resource
+    image_node = root.find('.//image')
+    if image_node is None:
+        image_node = root.find('.//resource')
+
+    if image_node is None:
+        raise ValueError("XML 文件中未找到 <image> 节点")
+
+    print("找到节点：", image_node.tag)
+    wi = int(image_node.attrib['width'])
+    hi = int(image_node.attrib['height'])
+    tsize = int(image_node.attrib['tilewidth'])
+    return wi, hi, tsize
+
+
+def fetch_tile(session, file_url, img_path, timeout):
+    """下载单个瓦片并保存，返回瓦片字节；失败返回 None"""
+    try:
+        img_response = session.get(file_url, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to download {file_url}: {e}")
+        return None
+    if img_response.status_code != 200:
+        print(f"Failed to download {file_url}. Status code: {img_response.status_code}")
+        return None
+    with open(img_path, "wb") as f:
+        f.write(img_response.content)
+    return img_response.content
+
+
+def download_takushoku_image(dzi, download_path, max_workers=16, timeout=(10, 30)):
+    """下载 root.xml 描述的整幅图像并拼接为 full.jpg，返回输出路径"""
+    os.makedirs(download_path, exist_ok=True)
+
+    with create_session(max_workers) as session:
+        wi, hi, tsize = parse_root_xml(session, dzi, timeout)
+        print(f"Width: {wi}, Height: {hi}, Tile Width: {tsize}")
+
+        # 计算列数和行数（向上取整，整除时不会多出一列/一行空瓦片）
+        cols = -(-wi // tsize)
+        rows = -(-hi // tsize)
+
+        # 预先分配整幅画布，每个瓦片只解码一次并直接贴到最终位置，不再生成 row{i}.jpg
+        full_image = Image.new('RGB', (wi, hi))
+        tile_base = dzi.replace('root.xml', '0/')
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for i in range(rows):
+                for j in range(cols):
+                    nh = tsize if i < rows - 1 else hi - i * tsize  # 最后一行/列取剩余尺寸
+                    nw = tsize if j < cols - 1 else wi - j * tsize
+                    image_name = f"{j * tsize:05d}{i * tsize:05d}{nw:05d}{nh:05d}.jpg"
+                    img_path = os.path.join(download_path, f"{j}_{i}.jpg")
+                    future = executor.submit(fetch_tile, session, f"{tile_base}{image_name}", img_path, timeout)
+                    futures[future] = (j, i)
+
+            done = 0
+            total = len(futures)
+            for future in as_completed(futures):
+                # 贴完即丢弃 future，已处理瓦片的字节不会一直留在内存里
+                j, i = futures.pop(future)
+                data = future.result()
+                del future
+                done += 1
+                if data is not None:
+                    with Image.open(BytesIO(data)) as tile:
+                        full_image.paste(tile, (j * tsize, i * tsize))
+                    del data
+                print(f"Downloaded {done}/{total} tiles", end='\r')
+
+    output_path = os.path.join(download_path, "full.jpg")
+    full_image.save(output_path)
+    print(f"\n全图已保存为 {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    download_path = os.path.join('E:\\2025', f'download_{timestamp}')
+    dzi = "https://opac.lib.takushoku-u.ac.jp/kyugaichi/htmls/resources/2013_013_001/root.xml"
+    download_takushoku_image(dzi, download_path)
@@ -0,0 +1,207 @@
+"""Streaming image-to-PDF writer shared by the PDF builders.
+
+JPEG files are embedded as-is as DCTDecode streams: only the JPEG header is
+read to get the pixel size and colour components, and the bytes are copied
+straight into the PDF. Other formats are decoded once with Pillow and stored
+losslessly with FlateDecode. Each page is written to disk as soon as it is
+added, so memory use does not grow with the page count.
+"""
+import os
+import struct
+import zlib
+from io import BytesIO
+from typing import BinaryIO, List, Optional, Tuple, Union
+
+A4_SIZE = (595.28, 841.89)  # points
+FIT_MODES = ("native", "a4")
+
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+_COLOR_SPACES = {1: "/DeviceGray", 3: "/DeviceRGB", 4: "/DeviceCMYK"}
+
+
+def read_jpeg_header(stream: BinaryIO) -> Optional[Tuple[int, int, int, bool]]:
+    """Return (width, height, components, adobe) by walking the JPEG markers, or None if not a JPEG.
+
+    Only the marker segments up to the frame header are read; entropy-coded
+    data is never touched.
+    """
+    if stream.read(2) != b"\xff\xd8":
+        return None
+    adobe = False
+    while True:
+        byte = stream.read(1)
+        if byte != b"\xff":
+            return None
+        marker = stream.read(1)
+        while marker == b"\xff":  # fill bytes
+            marker = stream.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # markers without a length
+            continue
+        raw_length = stream.read(2)
+        if len(raw_length) != 2:
+            return None
+        (length,) = struct.unpack(">H", raw_length)
+        segment = stream.read(length - 2)
+        if len(segment) != length - 2:
+            return None
+        if marker == 0xEE and segment.startswith(b"Adobe"):
+            adobe = True
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack(">HH", segment[1:5])
+            return width, height, segment[5], adobe
+        if marker == 0xDA:  # start of scan before any frame header
+            return None
+
+
+class ImagePDFWriter:
+    """Write one image per page to ``output_path``.
+
+    ``fit="native"`` makes each page the image's pixel size in points;
+    ``fit="a4"`` scales the image to fit an A4 page, keeping its aspect ratio.
+    """
+
+    def __init__(self, output_path: str, fit: str = "native"):
+        if fit not in FIT_MODES:
+            raise ValueError(f"fit must be one of {FIT_MODES}, not {fit!r}")
+        self.output_path = output_path
+        self.fit = fit
+        self._file = open(output_path, "wb")
+        self._offsets: List[int] = [0, 0, 0]  # object 0 is the free-list head; 1 catalog, 2 pages
+        self._pages: List[int] = []
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    def _reserve(self) -> int:
+        self._offsets.append(0)
+        return len(self._offsets) - 1
+
+    def _write_object(self, number: int, body: bytes, stream=None, length: int = 0) -> None:
+        """Write an object; ``stream`` is bytes or a file object copied in chunks."""
+        self._offsets[number] = self._file.tell()
+        self._file.write(b"%d 0 obj\n" % number)
+        self._file.write(body)
+        if stream is not None:
+            self._file.write(b"\nstream\n")
+            if isinstance(stream, bytes):
+                self._file.write(stream)
+            else:
+                remaining = length
+                while remaining:
+                    chunk = stream.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        raise IOError("image file shrank while being written")
+                    self._file.write(chunk)
+                    remaining -= len(chunk)
+            self._file.write(b"\nendstream")
+        self._file.write(b"\nendobj\n")
+
+    def _page_geometry(self, width: int, height: int):
+        if self.fit == "native":
+            return (width, height), (0, 0, width, height)
+        page_w, page_h = A4_SIZE
+        scale = min(page_w / width, page_h / height)
+        draw_w, draw_h = width * scale, height * scale
+        return (page_w, page_h), ((page_w - draw_w) / 2, (page_h - draw_h) / 2, draw_w, draw_h)
+
+    def _add_page(self, image_number: int, width: int, height: int) -> None:
+        (page_w, page_h), (x, y, draw_w, draw_h) = self._page_geometry(width, height)
+        content = b"q %.2f 0 0 %.2f %.2f %.2f cm /Im0 Do Q" % (draw_w, draw_h, x, y)
+        content_number = self._reserve()
+        self._write_object(content_number, b"<< /Length %d >>" % len(content), content)
+        page_number = self._reserve()
+        self._write_object(
+            page_number,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+            b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+            % (page_w, page_h, image_number, content_number)
+        )
+        self._pages.append(page_number)
+
+    def _image_dict(self, width: int, height: int, components: int, filter_name: bytes, length: int,
+                    adobe: bool = False) -> bytes:
+        decode = b" /Decode [1 0 1 0 1 0 1 0]" if components == 4 and adobe else b""
+        return (b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s "
+                b"/BitsPerComponent 8 /Filter %s /Length %d%s >>"
+                % (width, height, _COLOR_SPACES[components].encode(), filter_name, length, decode))
+
+    def add_jpeg(self, source: Union[str, bytes]) -> bool:
+        """Embed a JPEG without decoding it. Returns False if ``source`` is not a usable JPEG."""
+        if isinstance(source, bytes):
+            header = read_jpeg_header(BytesIO(source))
+        else:
+            with open(source, "rb") as f:
+                header = read_jpeg_header(f)
+        if header is None or header[2] not in _COLOR_SPACES:
+            return False
+
+        width, height, components, adobe = header
+        image_number = self._reserve()
+        if isinstance(source, bytes):
+            self._write_object(image_number, self._image_dict(width, height, components, b"/DCTDecode",
+                                                              len(source), adobe), source)
+        else:
+            length = os.path.getsize(source)
+            with open(source, "rb") as f:
+                self._write_object(image_number, self._image_dict(width, height, components, b"/DCTDecode",
+                                                                  length, adobe), f, length)
+        self._add_page(image_number, width, height)
+        return True
+
+    def add_pil_image(self, image) -> None:
+        """Embed a Pillow image losslessly (FlateDecode)."""
+        if image.mode not in ("L", "RGB", "CMYK"):
+            image = image.convert("RGB")
+        components = {"L": 1, "RGB": 3, "CMYK": 4}[image.mode]
+        data = zlib.compress(image.tobytes(), 6)
+        image_number = self._reserve()
+        self._write_object(image_number, self._image_dict(image.width, image.height, components,
+                                                          b"/FlateDecode", len(data)), data)
+        self._add_page(image_number, image.width, image.height)
+
+    def add_image(self, source: Union[str, bytes]) -> None:
+        """Add a page from a file path or encoded bytes, passing JPEGs through untouched."""
+        if self.add_jpeg(source):
+            return
+        from PIL import Image
+
+        with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as image:
+            self.add_pil_image(image)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        kids = b" ".join(b"%d 0 R" % number for number in self._pages)
+        self._write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self._pages)))
+
+        xref_offset = self._file.tell()
+        self._file.write(b"xref\n0 %d\n" % len(self._offsets))
+        self._file.write(b"0000000000 65535 f \n")
+        for offset in self._offsets[1:]:
+            self._file.write(b"%010d 00000 n \n" % offset)
+        self._file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                         % (len(self._offsets), xref_offset))
+        self._file.close()
+
+
+def images_to_pdf(image_paths, output_path: str, fit: str = "native") -> int:
+    """Write ``image_paths`` to ``output_path`` one page per image; returns the page count."""
+    with ImagePDFWriter(output_path, fit) as writer:
+        for image_path in image_paths:
+            try:
+                writer.add_image(image_path)
+            except (OSError, ValueError) as e:
+                print(f"Error processing file {image_path}: {e}")
+        return writer.page_count
@@ -0,0 +1,57 @@
+"""Per-host token-bucket rate limiter with a cap on in-flight requests.
+
+One ``HostRateLimiter`` is shared by all worker threads. Each request takes a
+token from its host's bucket (``rate`` requests per second, bursting up to
+``burst``) and holds one of ``max_in_flight`` slots while it runs, so several
+requests can overlap without exceeding the site's allowance.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+
+class _Bucket:
+    def __init__(self, rate: float, burst: float, max_in_flight: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+
+
+class HostRateLimiter:
+    def __init__(self, rate: float = 1.0, burst: float = 1.0, max_in_flight: int = 4):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _bucket(self, host: str) -> _Bucket:
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = _Bucket(self.rate, self.burst, self.max_in_flight)
+            return self._buckets[host]
+
+    def _take_token(self, host: str) -> None:
+        bucket = self._bucket(host)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket.tokens = min(bucket.burst, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                bucket.updated = now
+                if bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    return
+                wait = (1 - bucket.tokens) / bucket.rate
+            time.sleep(wait)
+
+    @contextmanager
+    def limit(self, url: str):
+        """Hold an in-flight slot and one rate token for ``url``'s host while the block runs."""
+        host = urlparse(url).netloc
+        bucket = self._bucket(host)
+        with bucket.slots:
+            self._take_token(host)
+            yield
@@ -0,0 +1,235 @@
+"""Shared retry, backoff and per-host circuit-breaker policy for the downloaders.
+
+Sync callers use ``request_with_retry`` with a ``requests.Session``; asyncio
+callers use ``async_get_with_retry`` with an ``aiohttp.ClientSession``. Both
+share the same ``RetryPolicy`` and ``HostBreaker`` so that when one worker sees
+a host throttling, every worker talking to that host backs off together.
+
+Rate limiters, concurrency slots and adaptive controllers plug in per attempt
+through ``attempt_slot`` and ``on_attempt``, so every retry is counted and no
+slot is held during a backoff sleep.
+"""
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, nullcontext
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+try:
+    import requests
+    _NETWORK_ERRORS = (requests.exceptions.RequestException,)
+except ImportError:  # the asyncio helpers do not need requests
+    requests = None
+    _NETWORK_ERRORS = ()
+
+
+# Outcome classes returned by RetryPolicy.classify()
+OK = "ok"
+NOT_FOUND = "not_found"
+RETRY = "retry"
+FATAL = "fatal"
+
+THROTTLE_STATUSES = {429, 503}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return the Retry-After header as seconds, accepting delta-seconds or an HTTP date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HostBreaker:
+    """Per-host circuit breaker shared by all threads and tasks.
+
+    A throttling response (429/503) pauses the host for the suggested delay.
+    ``failure_threshold`` consecutive failures open the circuit for ``cooldown``
+    seconds. Any success closes it again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._paused_until = {}
+        self._failures = {}
+
+    def wait_time(self, host: str) -> float:
+        """Seconds a caller must wait before sending another request to ``host``."""
+        with self._lock:
+            return max(self._paused_until.get(host, 0.0) - time.monotonic(), 0.0)
+
+    def pause(self, host: str, seconds: float) -> None:
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until.get(host, 0.0):
+                self._paused_until[host] = until
+
+    def record_success(self, host: str) -> None:
+        with self._lock:
+            self._failures[host] = 0
+
+    def record_failure(self, host: str) -> None:
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+        if failures >= self.failure_threshold:
+            print(f"\nCircuit open for {host}: {failures} consecutive failures, pausing {self.cooldown:.0f}s")
+            self.pause(host, self.cooldown)
+
+
+# Breaker used when the caller does not pass its own
+default_breaker = HostBreaker()
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, honouring Retry-After."""
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 1.0, max_delay: float = 60.0,
+                 retry_statuses=(408, 425, 429, 500, 502, 503, 504), breaker: Optional[HostBreaker] = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = set(retry_statuses)
+        self.breaker = breaker or default_breaker
+
+    def classify(self, status: int) -> str:
+        """Map an HTTP status to OK, NOT_FOUND, RETRY or FATAL."""
+        if 200 <= status < 300:
+            return OK
+        if status in (404, 410):
+            return NOT_FOUND
+        if status in self.retry_statuses:
+            return RETRY
+        return FATAL
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Delay before retry number ``attempt`` (1-based)."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def on_response(self, host: str, status: int, retry_after: Optional[str], attempt: int) -> Optional[float]:
+        """Update the breaker for a response; return the delay to retry after, or None to stop."""
+        outcome = self.classify(status)
+        if outcome in (OK, NOT_FOUND):
+            self.breaker.record_success(host)
+            return None
+        self.breaker.record_failure(host)
+        if outcome == FATAL or attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt, parse_retry_after(retry_after))
+        if status in THROTTLE_STATUSES:
+            # Slow every worker on this host down, not only this one
+            self.breaker.pause(host, delay)
+        return delay
+
+    def on_error(self, host: str, attempt: int) -> Optional[float]:
+        """Update the breaker for a network error; return the delay to retry after, or None to stop."""
+        self.breaker.record_failure(host)
+        if attempt >= self.max_attempts:
+            return None
+        return self.backoff(attempt)
+
+
+default_policy = RetryPolicy()
+
+
+@asynccontextmanager
+async def _no_async_slot():
+    yield
+
+
+def request_with_retry(session, url: str, policy: Optional[RetryPolicy] = None, method: str = "GET",
+                       attempt_slot: Optional[Callable] = None,
+                       on_attempt: Optional[Callable[[Optional[int], float], None]] = None, **kwargs):
+    """Send a request through ``requests`` with the shared policy.
+
+    ``session`` may be a ``requests.Session`` or the ``requests`` module itself.
+
+    ``attempt_slot`` returns a context manager held around each single attempt
+    (for example ``lambda: limiter.limit(url)``). ``on_attempt(status, latency)``
+    is called after every attempt, with ``status`` None for a network error and
+    ``latency`` excluding backoff sleeps.
+
+    Returns the final response (which may be a 404 or other non-retryable
+    status). Re-raises the last ``requests.RequestException`` when every
+    attempt failed at the network level.
+    """
+    policy = policy or default_policy
+    attempt_slot = attempt_slot or nullcontext
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        attempt += 1
+        time.sleep(policy.breaker.wait_time(host))
+        response = error = None
+        with attempt_slot():
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except _NETWORK_ERRORS as e:
+                error = e
+            if on_attempt is not None:
+                on_attempt(None if error else response.status_code, time.monotonic() - start)
+
+        if error is not None:
+            delay = policy.on_error(host, attempt)
+            if delay is None:
+                raise error
+        else:
+            delay = policy.on_response(host, response.status_code, response.headers.get("Retry-After"), attempt)
+            if delay is None:
+                return response
+            response.close()
+        time.sleep(delay)
+
+
+async def async_get_with_retry(session, url: str, policy: Optional[RetryPolicy] = None,
+                               attempt_slot: Optional[Callable] = None, **kwargs):
+    """GET through ``aiohttp`` with the shared policy.
+
+    ``attempt_slot`` returns an async context manager held around each single
+    attempt, so backoff sleeps never hold it.
+
+    Returns ``(status, body)`` where ``body`` is only read for 2xx responses.
+    Re-raises the last ``aiohttp.ClientError``/timeout when every attempt failed.
+    """
+    import aiohttp
+
+    policy = policy or default_policy
+    attempt_slot = attempt_slot or _no_async_slot
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        attempt += 1
+        await asyncio.sleep(policy.breaker.wait_time(host))
+        error = None
+        async with attempt_slot():
+            try:
+                async with session.get(url, **kwargs) as response:
+                    status = response.status
+                    body = await response.read() if 200 <= status < 300 else None
+                    retry_after = response.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+        if error is not None:
+            delay = policy.on_error(host, attempt)
+            if delay is None:
+                raise error
+        else:
+            delay = policy.on_response(host, status, retry_after, attempt)
+            if delay is None:
+                return status, body
+        await asyncio.sleep(delay)
@@ -0,0 +1,91 @@
+import re
+import struct
+from io import BytesIO
+
+import pytest
+
+from image_pdf import ImagePDFWriter, images_to_pdf, read_jpeg_header
+
+
+def make_jpeg(width, height, components=3, adobe=False):
+    """Marker segments of a baseline JPEG; enough for header parsing and passthrough."""
+    data = b"\xff\xd8"
+    data += b"\xff\xe0" + struct.pack(">H", 16) + b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    if adobe:
+        data += b"\xff\xee" + struct.pack(">H", 14) + b"Adobe\x00\x64\x00\x00\x00\x00\x02"
+    frame = struct.pack(">BHHB", 8, height, width, components) + b"\x01\x11\x00" * components
+    data += b"\xff\xc0" + struct.pack(">H", len(frame) + 2) + frame
+    return data + b"\xff\xda\x00\x02\xff\xd9"
+
+
+def test_read_jpeg_header():
+    assert read_jpeg_header(BytesIO(make_jpeg(640, 480))) == (640, 480, 3, False)
+    assert read_jpeg_header(BytesIO(make_jpeg(10, 20, 4, adobe=True))) == (10, 20, 4, True)
+
+
+def test_read_jpeg_header_rejects_other_data():
+    assert read_jpeg_header(BytesIO(b"\x89PNG\r\n\x1a\n")) is None
+    assert read_jpeg_header(BytesIO(make_jpeg(640, 480)[:20])) is None
+
+
+def test_invalid_fit_mode(tmp_path):
+    with pytest.raises(ValueError):
+        ImagePDFWriter(str(tmp_path / "out.pdf"), fit="letter")
+
+
+def test_add_jpeg_rejects_non_jpeg(tmp_path):
+    with ImagePDFWriter(str(tmp_path / "out.pdf")) as writer:
+        assert writer.add_jpeg(b"\x89PNG\r\n\x1a\n") is False
+        assert writer.page_count == 0
+
+
+def test_jpeg_bytes_are_embedded_unchanged(tmp_path):
+    jpeg = make_jpeg(300, 200)
+    path = tmp_path / "out.pdf"
+    with ImagePDFWriter(str(path), fit="native") as writer:
+        assert writer.add_jpeg(jpeg)
+    pdf = path.read_bytes()
+
+    assert jpeg in pdf
+    assert b"/Filter /DCTDecode" in pdf
+    assert b"/MediaBox [0 0 300.00 200.00]" in pdf
+
+
+def test_a4_fit_keeps_aspect_ratio(tmp_path):
+    path = tmp_path / "out.pdf"
+    with ImagePDFWriter(str(path), fit="a4") as writer:
+        writer.add_jpeg(make_jpeg(1000, 500))
+    pdf = path.read_bytes()
+
+    assert b"/MediaBox [0 0 595.28 841.89]" in pdf
+    draw_w, draw_h = map(float, re.search(rb"q (\S+) 0 0 (\S+) ", pdf).groups())
+    assert draw_w == pytest.approx(595.28, abs=0.01)
+    assert draw_w / draw_h == pytest.approx(2.0, abs=0.01)
+
+
+def test_xref_offsets_point_at_objects(tmp_path):
+    path = tmp_path / "out.pdf"
+    files = []
+    for i in range(3):
+        image_path = tmp_path / f"{i}.jpg"
+        image_path.write_bytes(make_jpeg(100 + i, 100))
+        files.append(str(image_path))
+
+    assert images_to_pdf(files, str(path)) == 3
+    pdf = path.read_bytes()
+
+    start = int(re.search(rb"startxref\n(\d+)", pdf).group(1))
+    assert pdf[start:start + 4] == b"xref"
+    count = int(re.match(rb"xref\n0 (\d+)\n", pdf[start:]).group(1))
+    entries = re.findall(rb"(\d{10}) 00000 n \n", pdf[start:])
+    assert len(entries) == count - 1
+    for number, offset in enumerate(entries, 1):
+        assert pdf[int(offset):].startswith(b"%d 0 obj" % number)
+    assert b"/Count 3" in pdf
+
+
+def test_images_to_pdf_skips_unreadable_files(tmp_path):
+    good = tmp_path / "good.jpg"
+    good.write_bytes(make_jpeg(50, 50))
+
+    assert images_to_pdf([str(tmp_path / "missing.jpg"), str(good)], str(tmp_path / "out.pdf")) == 1
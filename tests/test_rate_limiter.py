@@ -0,0 +1,74 @@
+import threading
+import time
+
+from rate_limiter import HostRateLimiter
+
+
+def test_burst_then_rate():
+    limiter = HostRateLimiter(rate=20.0, burst=2, max_in_flight=4)
+    start = time.monotonic()
+    for _ in range(6):
+        with limiter.limit("http://example.org/a"):
+            pass
+    # Two tokens are available at once, the other four arrive at 20 per second
+    assert time.monotonic() - start >= 0.18
+
+
+def test_hosts_have_separate_buckets():
+    limiter = HostRateLimiter(rate=1.0, burst=1, max_in_flight=4)
+    start = time.monotonic()
+    for host in ("a.example", "b.example", "c.example"):
+        with limiter.limit(f"http://{host}/x"):
+            pass
+    assert time.monotonic() - start < 0.5
+
+
+def test_in_flight_cap():
+    limiter = HostRateLimiter(rate=1000.0, burst=1000, max_in_flight=2)
+    lock = threading.Lock()
+    active = peak = 0
+
+    def worker():
+        nonlocal active, peak
+        with limiter.limit("http://example.org/x"):
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            time.sleep(0.02)
+            with lock:
+                active -= 1
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak == 2
+
+
+def test_every_retry_takes_a_token():
+    from retry_policy import HostBreaker, RetryPolicy, request_with_retry
+
+    class Response:
+        status_code = 403
+        headers = {}
+
+        def close(self):
+            pass
+
+    sent = []
+
+    class Session:
+        def request(self, method, url, **kwargs):
+            sent.append(time.monotonic())
+            return Response()
+
+    limiter = HostRateLimiter(rate=20.0, burst=1, max_in_flight=1)
+    policy = RetryPolicy(max_attempts=4, base_delay=0.0, retry_statuses=(403,),
+                         breaker=HostBreaker(failure_threshold=100))
+    url = "http://example.org/x"
+    request_with_retry(Session(), url, policy, attempt_slot=lambda: limiter.limit(url))
+
+    # Four attempts at 20 per second with a burst of one: at least three token waits
+    assert len(sent) == 4
+    assert sent[-1] - sent[0] >= 0.14
@@ -0,0 +1,132 @@
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from retry_policy import FATAL, NOT_FOUND, OK, RETRY, HostBreaker, RetryPolicy, parse_retry_after, request_with_retry
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Replays a list of outcomes: a status, a (status, headers) pair, or an exception to raise."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, tuple):
+            return FakeResponse(*outcome)
+        return FakeResponse(outcome)
+
+
+def fast_policy(**kwargs):
+    kwargs.setdefault("base_delay", 0.001)
+    kwargs.setdefault("max_delay", 0.01)
+    return RetryPolicy(breaker=HostBreaker(failure_threshold=100), **kwargs)
+
+
+def test_classify():
+    policy = RetryPolicy()
+    assert policy.classify(200) == OK
+    assert policy.classify(404) == NOT_FOUND
+    assert policy.classify(503) == RETRY
+    assert policy.classify(403) == FATAL
+    assert RetryPolicy(retry_statuses=(403,)).classify(403) == RETRY
+
+
+def test_backoff_is_bounded_and_honours_retry_after():
+    policy = RetryPolicy(base_delay=1.0, max_delay=8.0)
+    for attempt in range(1, 10):
+        assert 0 <= policy.backoff(attempt) <= min(8.0, 2 ** (attempt - 1))
+    assert policy.backoff(1, retry_after=5.0) >= 5.0
+    assert policy.backoff(1, retry_after=100.0) <= 8.0
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("Thu, 01 Jan 1970 00:00:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
+
+
+def test_retries_until_success():
+    session = FakeSession([503, 429, 200])
+    response = request_with_retry(session, "http://example.org/x", fast_policy())
+    assert response.status_code == 200
+    assert session.calls == 3
+
+
+def test_returns_last_response_when_attempts_run_out():
+    session = FakeSession([503] * 3)
+    response = request_with_retry(session, "http://example.org/x", fast_policy(max_attempts=3))
+    assert response.status_code == 503
+    assert session.calls == 3
+
+
+def test_does_not_retry_not_found_or_fatal():
+    for status in (404, 403):
+        session = FakeSession([status])
+        assert request_with_retry(session, "http://example.org/x", fast_policy()).status_code == status
+        assert session.calls == 1
+
+
+def test_on_attempt_sees_every_attempt():
+    outcomes = []
+    session = FakeSession([429, 503, 200])
+    request_with_retry(session, "http://example.org/x", fast_policy(),
+                       on_attempt=lambda status, latency: outcomes.append(status))
+    assert outcomes == [429, 503, 200]
+
+
+def test_slot_is_released_during_backoff():
+    events = []
+
+    @contextmanager
+    def slot():
+        events.append(("enter", time.monotonic()))
+        yield
+        events.append(("exit", time.monotonic()))
+
+    latencies = []
+    # Retry-After 1 s capped at max_delay forces a 0.05 s backoff between the attempts
+    session = FakeSession([(429, {"Retry-After": "1"}), 200])
+    request_with_retry(session, "http://example.org/x", fast_policy(max_delay=0.05), attempt_slot=slot,
+                       on_attempt=lambda status, latency: latencies.append(latency))
+
+    assert [kind for kind, _ in events] == ["enter", "exit", "enter", "exit"]
+    assert events[2][1] - events[1][1] >= 0.04
+    assert all(latency < 0.04 for latency in latencies)
+
+
+def test_network_errors_are_retried_then_reraised():
+    requests = pytest.importorskip("requests")
+    outcomes = []
+    session = FakeSession([requests.exceptions.ConnectionError("down")] * 2)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        request_with_retry(session, "http://example.org/x", fast_policy(max_attempts=2),
+                           on_attempt=lambda status, latency: outcomes.append(status))
+    assert session.calls == 2
+    assert outcomes == [None, None]
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = HostBreaker(failure_threshold=2, cooldown=30.0)
+    breaker.record_failure("example.org")
+    assert breaker.wait_time("example.org") == 0
+    breaker.record_failure("example.org")
+    assert breaker.wait_time("example.org") > 29
+    assert breaker.wait_time("other.example") == 0
+
@@ -1,15 +1,84 @@
 import os
 import sys
-import time
 import re
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 import requests
-from PIL import Image
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+from image_pdf import ImagePDFWriter
+from retry_policy import request_with_retry
+
+
+# 页面加载前注入：用 MutationObserver / PerformanceObserver 事件记录大图 URL 及其所在页码，
+# 取代每次翻页后全量扫描 DOM
+CAPTURE_SCRIPT = r"""
+window.__yzPages = {};
+window.__yzOrder = [];
+function __yzRecord(url, page) {
+    if (!url || url.indexOf('/files/large/') < 0) return;
+    url = url.split('?')[0];
+    if (!(url in window.__yzPages)) {
+        window.__yzPages[url] = null;
+        window.__yzOrder.push(url);
+    }
+    if (page !== null && window.__yzPages[url] === null) window.__yzPages[url] = page;
+}
+function __yzRecordImg(img) {
+    var pageDiv = img.closest && img.closest('div[id^="page"]');
+    var match = pageDiv && pageDiv.id.match(/page(\d+)/);
+    __yzRecord(img.getAttribute('src') && img.src, match ? parseInt(match[1]) : null);
+}
+new MutationObserver(function (mutations) {
+    mutations.forEach(function (m) {
+        if (m.type === 'attributes') {
+            if (m.target.tagName === 'IMG') __yzRecordImg(m.target);
+            return;
+        }
+        m.addedNodes.forEach(function (n) {
+            if (n.tagName === 'IMG') __yzRecordImg(n);
+            else if (n.querySelectorAll) n.querySelectorAll('img').forEach(__yzRecordImg);
+        });
+    });
+}).observe(document, {subtree: true, childList: true, attributes: true, attributeFilter: ['src']});
+new PerformanceObserver(function (list) {
+    list.getEntries().forEach(function (e) { __yzRecord(e.name, null); });
+}).observe({type: 'resource', buffered: true});
+"""
+
+# 捕获页面地址用不到的资源，通过 CDP 直接拦截：缩略图、封面截图、界面图标、字体和音视频。
+# /files/large/ 大图必须照常加载，PerformanceObserver 靠它们的加载事件拿到地址
+BLOCKED_RESOURCES = [
+    "*/files/thumb/*", "*/files/shot.*", "*.gif", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.mp3", "*.mp4", "*.webm", "*.ogg",
+]
+
+
+def create_session(pool_size):
+    """带连接池的会话，所有下载线程复用 keep-alive 连接"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_page(session, img_url, index):
+    """下载单页图片，返回原始字节；失败返回 None"""
+    try:
+        response = request_with_retry(session, img_url, timeout=15)
+        if response.status_code == 200:
+            return response.content
+        print(f"\n[警告] 第 {index + 1} 页下载失败，状态码: {response.status_code}")
+    except Exception as e:
+        print(f"\n[警告] 第 {index + 1} 页下载异常: {e}")
+    return None
 
 
-def download_yunzhan_pdf(url, output_filename="xx.pdf"):
+def download_yunzhan_pdf(url, output_filename="xx.pdf", max_workers=8, window=16):
     print(f"开始处理链接: {url}")
 
     # 1. 配置 Selenium (移除了性能日志监听，大幅降低内存占用防止崩溃)
@@ -19,13 +88,24 @@ def download_yunzhan_pdf(url, output_filename="xx.pdf"):
 
     print("正在启动 Chrome 浏览器...")
     driver = webdriver.Chrome(options=options)
+    driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": CAPTURE_SCRIPT})
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_RESOURCES})
 
     final_page_links = []
 
     try:
         driver.get(url)
-        print("等待页面加载（5秒）...")
-        time.sleep(5)
+        print("等待页面就绪...")
+        try:
+            WebDriverWait(driver, 30, poll_frequency=0.2).until(lambda d: d.execute_script("""
+                return document.readyState === 'complete' && (
+                    typeof window.bookConfig !== 'undefined' ||
+                    typeof window.originTotalPageCount !== 'undefined' ||
+                    typeof window.totalPageCount !== 'undefined');
+            """))
+        except TimeoutException:
+            print("页面就绪信号超时，继续尝试读取...")
 
         # ================= 核心改进方案 A：直接读取内存中的书籍配置 (最快最准) =================
         print("尝试从浏览器内存中直接读取全书页码顺序...")
@@ -82,48 +162,36 @@ def download_yunzhan_pdf(url, output_filename="xx.pdf"):
             print(f"书籍总页数: {num_pages}")
             flips = ceil((num_pages - 1) / 2)
 
-            page_links = []
-
-            def get_dom_page_map():
-                """扫描当前 DOM，建立 URL -> 真实页码 的准确映射关系"""
-                return driver.execute_script("""
-                    let map = {};
-                    let imgs = document.querySelectorAll('img[src*="/files/large/"]');
-                    for(let i=0; i<imgs.length; i++) {
-                        let img = imgs[i];
-                        let pageDiv = img.closest('div[id^="page"]');
-                        if (pageDiv) {
-                            let match = pageDiv.id.match(/page(\d+)/);
-                            if (match) {
-                                map[img.src.split('?')[0]] = parseInt(match[1]);
-                            }
-                        }
-                    }
-                    return map;
-                """)
-
-            dom_map = get_dom_page_map()
-            initial_urls = list(dom_map.keys())
-            # 根据 DOM 中的真实页码排序，而不是根据 URL 字母排序！
-            initial_urls.sort(key=lambda u: dom_map.get(u, 0))
-            page_links.extend(initial_urls)
+            def captured_count():
+                return driver.execute_script("return (window.__yzOrder || []).length;")
 
             for i in range(flips):
                 current_p1 = 1 + 2 * i
                 current_p2 = 2 + 2 * i
                 print(f"\r正在翻页并动态捕获: {current_p1} & {current_p2} / {num_pages} 页...", end="", flush=True)
 
+                before = captured_count()
                 driver.execute_script("nextPageFun(\"mouse wheel flip\")")
-                time.sleep(1.5)
-
-                new_dom_map = get_dom_page_map()
-                dom_map.update(new_dom_map)
-
-                turn_urls = [u for u in new_dom_map.keys() if u not in page_links]
-                turn_urls.sort(key=lambda u: dom_map.get(u, 0))
-                page_links.extend(turn_urls)
-
-            final_page_links = page_links
+                # 新页面的图片地址一出现就继续翻页，不再固定等待
+                try:
+                    WebDriverWait(driver, 5, poll_frequency=0.1).until(lambda d: captured_count() > before)
+                except TimeoutException:
+                    pass
+
+            order, page_map = driver.execute_script(
+                "return [window.__yzOrder || [], window.__yzPages || {}];"
+            )
+            # 按页码排序；没有页码的地址沿用前一个已知页码，保持捕获顺序
+            keyed = []
+            last_page = 0
+            for position, link in enumerate(order):
+                page_no = page_map.get(link)
+                if page_no is None:
+                    page_no = last_page
+                else:
+                    last_page = page_no
+                keyed.append((page_no, position, link))
+            final_page_links = [link for _, _, link in sorted(keyed)]
             print("\n页面捕获完成！")
 
     finally:
@@ -147,28 +215,37 @@ def download_yunzhan_pdf(url, output_filename="xx.pdf"):
 
     print(f"最终整理出图片数: {len(unique_links)} 张")
 
-    # 3. 下载图片并合成 PDF
-    images = []
-    print("开始顺序下载图片并转换为 PDF 格式...")
-    for index, img_url in enumerate(unique_links):
-        print(f"\r正在处理第 {index + 1} / {len(unique_links)} 页...", end="", flush=True)
-        try:
-            response = requests.get(img_url, timeout=15)
-            if response.status_code == 200:
-                img = Image.open(BytesIO(response.content)).convert("RGB")
-                images.append(img)
-            else:
-                print(f"\n[警告] 第 {index + 1} 页下载失败，状态码: {response.status_code}")
-        except Exception as e:
-            print(f"\n[警告] 第 {index + 1} 页下载异常: {e}")
-
-    if not images:
+    # 3. 并发下载图片，按页序逐页写入 PDF；内存中最多只保留 window 页
+    print("开始并发下载图片并逐页写入 PDF...")
+    total = len(unique_links)
+    with create_session(max_workers) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            ImagePDFWriter(output_filename, fit="native") as writer:
+        futures = {}
+        next_submit = 0
+        for index in range(total):
+            # 滑动窗口：只提前提交 window 页，避免已下载未写入的页面无限堆积
+            while next_submit < total and next_submit < index + window:
+                futures[next_submit] = executor.submit(fetch_page, session, unique_links[next_submit], next_submit)
+                next_submit += 1
+
+            content = futures.pop(index).result()
+            print(f"\r正在处理第 {index + 1} / {total} 页...", end="", flush=True)
+            if content is None:
+                continue
+            try:
+                writer.add_image(content)
+            except Exception as e:
+                print(f"\n[警告] 第 {index + 1} 页写入失败: {e}")
+
+        page_count = writer.page_count
+
+    if not page_count:
+        os.remove(output_filename)
         print("\n没有成功下载到任何图片，无法生成 PDF。")
         return
 
-    print(f"\n正在合成并保存为 PDF 文件: {output_filename} ...")
-    images[0].save(output_filename, save_all=True, append_images=images[1:])
-    print("已生成完毕！")
+    print(f"\n已生成完毕！共 {page_count} 页: {output_filename}")
 
 
 if __name__ == "__main__":
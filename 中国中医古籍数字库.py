@@ -1,82 +1,221 @@
 import os
+import sqlite3
 import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from DrissionPage import ChromiumPage
 from pypdf import PdfWriter
 import requests
+from requests.adapters import HTTPAdapter
 
+from rate_limiter import HostRateLimiter
+from retry_policy import RetryPolicy, request_with_retry
 
-def download_and_merge_pdfs(book_id, total_pages, output_filename="merged_book.pdf"):
-    # 1. Initialize DrissionPage (ChromiumPage)
-    # This opens a browser instance which helps bypass basic anti-bot protections and handles sessions
-    page = ChromiumPage()
+try:
+    import pikepdf  # optional: rewrites the merged file with compressed object streams
+except ImportError:
+    pikepdf = None
 
-    # Create a temporary directory to store individual pages
-    temp_dir = "temp_pdf_pages"
-    os.makedirs(temp_dir, exist_ok=True)
+PAGE_URL_TEMPLATE = "https://gydc-v4.cintcm.cn/retrieve/page/getPdf?bookId={book_id}&page={page_num}"
 
-    # Get the session/cookies from DrissionPage to use with requests for faster downloading
-    # If the site requires login, log in manually in the browser window before starting
-    session = requests.Session()
-    for cookie in page.cookies():
-        session.cookies.set(cookie['name'], cookie['value'])
+retry_policy = RetryPolicy()
 
-    headers = {
-        "User-Agent": page.user_agent,
-        "Referer": f"https://gydc-v4.cintcm.cn/"
-    }
+# Font file -> font descriptor -> font dictionary -> page resources: one pass per level of nesting
+DEDUPE_PASSES = 4
 
-    downloaded_files = []
 
-    print(f"Starting download of {total_pages} pages...")
+class PageCheckpoint:
+    """SQLite store of the pages already fetched, so an interrupted run resumes where it stopped"""
 
-    try:
-        for page_num in range(1, total_pages + 1):
-            url = f"https://gydc-v4.cintcm.cn/retrieve/page/getPdf?bookId={book_id}&page={page_num}"
-            file_path = os.path.join(temp_dir, f"page_{page_num}.pdf")
-
-            # Download the file using requests (faster than navigating the browser for 411 pages)
-            response = session.get(url, headers=headers, stream=True)
-
-            if response.status_code == 200:
-                with open(file_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                downloaded_files.append(file_path)
-                print(f"Successfully downloaded page {page_num}/{total_pages}")
-            else:
-                print(f"Failed to download page {page_num}. Status code: {response.status_code}")
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            ' book_id TEXT NOT NULL, page_num INTEGER NOT NULL, data BLOB NOT NULL,'
+            ' fetched_at REAL NOT NULL, PRIMARY KEY (book_id, page_num))'
+        )
+        self.conn.commit()
+
+    def done(self, book_id):
+        """Return the set of page numbers already stored for this book"""
+        cursor = self.conn.execute('SELECT page_num FROM pages WHERE book_id = ?', (book_id,))
+        return {row[0] for row in cursor.fetchall()}
 
-            # Anti-banning safety delay (adjust as needed)
-            time.sleep(0.5)
+    def load(self, book_id, page_num):
+        cursor = self.conn.execute('SELECT data FROM pages WHERE book_id = ? AND page_num = ?', (book_id, page_num))
+        row = cursor.fetchone()
+        return row[0] if row else None
 
-        # 2. Merge PDFs using pypdf
-        if downloaded_files:
-            print("\nMerging PDFs... Please wait.")
-            merger = PdfWriter()
+    def save(self, book_id, page_num, data):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO pages (book_id, page_num, data, fetched_at) VALUES (?, ?, ?, ?)',
+            (book_id, page_num, data, time.time())
+        )
+        self.conn.commit()
 
-            for pdf in downloaded_files:
-                merger.append(pdf)
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
 
-            merger.write(output_filename)
 
-            print(f"\nSuccess! All pages merged into: {output_filename}")
+def create_session(page, pool_size):
+    """Copy the browser's cookies and user agent into a pooled requests session"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    for cookie in page.cookies():
+        session.cookies.set(cookie['name'], cookie['value'])
+    session.headers.update({
+        "User-Agent": page.user_agent,
+        "Referer": "https://gydc-v4.cintcm.cn/"
+    })
+    return session
+
+
+def fetch_page(session, limiter, book_id, page_num):
+    """Download one page PDF into memory; returns its bytes, or None on failure"""
+    url = PAGE_URL_TEMPLATE.format(book_id=book_id, page_num=page_num)
+    try:
+        # The limiter caps requests per second and in-flight requests for the host;
+        # every retry takes its own token and no slot is held while backing off
+        response = request_with_retry(session, url, retry_policy, timeout=(10, 60),
+                                      attempt_slot=lambda: limiter.limit(url))
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to download page {page_num}: {e}")
+        return None
+
+    if response.status_code != 200:
+        print(f"Failed to download page {page_num}. Status code: {response.status_code}")
+        return None
+    # The site answers some errors with an HTML page and status 200
+    if not response.content.startswith(b"%PDF"):
+        print(f"Failed to download page {page_num}: response is not a PDF")
+        return None
+    return response.content
+
+
+def _format_size(size):
+    return f"{size / 1024 / 1024:.2f} MB"
+
+
+def write_deduplicated(merger, output_filename, passes=DEDUPE_PASSES):
+    """
+    Write the merged book with identical objects stored only once.
+
+    Every page PDF from the site carries its own copy of the same fonts, color
+    spaces and often images. pypdf content-hashes all indirect objects and points
+    every reference at a single copy. Returns the size of the written file.
+    """
+    for page in merger.pages:
+        page.compress_content_streams()
+
+    # One pass merges e.g. identical FontFile streams; only then do the font
+    # descriptors and font dictionaries pointing at them become identical
+    for _ in range(passes):
+        merger.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    merger.write(output_filename)
+
+    if pikepdf is not None:
+        # pypdf has no object stream writer; pikepdf rewrites the file with small objects packed
+        with pikepdf.open(output_filename, allow_overwriting_input=True) as pdf:
+            pdf.save(output_filename, compress_streams=True,
+                     object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    return os.path.getsize(output_filename)
+
+
+def download_and_merge_pdfs(book_id, total_pages, output_filename="merged_book.pdf",
+                            rate=2.0, max_workers=4, window=16, checkpoint_path=None, dedupe=True):
+    """
+    Download every page concurrently and merge them in page order as they arrive.
+
+    :param rate: requests per second sent to the host
+    :param max_workers: concurrent downloads
+    :param window: pages fetched ahead of the merge position, bounding memory use
+    :param checkpoint_path: SQLite file for fetched pages; rerunning resumes from it
+    :param dedupe: store fonts, images and other objects shared by pages only once
+    """
+    checkpoint_path = checkpoint_path or f"{output_filename}.checkpoint.sqlite"
+    checkpoint = PageCheckpoint(checkpoint_path)
+    done = checkpoint.done(book_id)
+    missing = [page_num for page_num in range(1, total_pages + 1) if page_num not in done]
+    if done:
+        print(f"Resuming: {len(done)} pages found in {checkpoint_path}")
+
+    # 1. Only open the browser (for cookies/UA) when there is something left to fetch.
+    # If the site requires login, log in manually in the browser window before starting
+    page = ChromiumPage() if missing else None
+    limiter = HostRateLimiter(rate=rate, burst=max_workers, max_in_flight=max_workers)
+
+    print(f"Starting download of {len(missing)} of {total_pages} pages...")
+
+    merger = PdfWriter()
+    merged_pages = 0
+    fetched_bytes = 0
+    failed = []
+    try:
+        with (create_session(page, max_workers) if page else requests.Session()) as session, \
+                ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            next_submit = 0
+
+            # 2. Ordered merge: page N is appended as soon as pages 1..N have been handled
+            for page_num in range(1, total_pages + 1):
+                # Keep at most `window` pages in flight or waiting ahead of the merge position
+                while next_submit < len(missing) and missing[next_submit] < page_num + window:
+                    future_page = missing[next_submit]
+                    futures[future_page] = executor.submit(fetch_page, session, limiter, book_id, future_page)
+                    next_submit += 1
+
+                if page_num in futures:
+                    data = futures.pop(page_num).result()
+                    if data is None:
+                        failed.append(page_num)
+                        continue
+                    checkpoint.save(book_id, page_num, data)
+                    print(f"Successfully downloaded page {page_num}/{total_pages}")
+                else:
+                    data = checkpoint.load(book_id, page_num)
+
+                try:
+                    merger.append(BytesIO(data))
+                    merged_pages += 1
+                    fetched_bytes += len(data)
+                except Exception as e:
+                    print(f"Failed to merge page {page_num}: {e}")
+                    failed.append(page_num)
+
+        # 3. Write the merged book
+        if merged_pages:
+            print("\nWriting merged PDF... Please wait.")
+            if dedupe:
+                after = write_deduplicated(merger, output_filename)
+                print(f"Deduplicated shared objects: {_format_size(fetched_bytes)} of page PDFs -> "
+                      f"{_format_size(after)} ({100 * (1 - after / fetched_bytes):.1f}% smaller)")
+            else:
+                merger.write(output_filename)
+            print(f"\nSuccess! {merged_pages} pages merged into: {output_filename}")
         else:
             print("\nNo pages were downloaded. Merger skipped.")
 
     finally:
-        # 3. Clean up temporary files
-        print("Cleaning up temporary files...")
-        for file in downloaded_files:
+        merger.close()
+        checkpoint.close()
+        if page:
+            page.quit()
+
+    if failed:
+        # Keep the checkpoint so the next run only fetches these pages
+        print(f"Pages missing from the merged PDF: {failed}")
+        print(f"Run again to retry them; fetched pages are kept in {checkpoint_path}")
+    else:
+        for suffix in ("", "-wal", "-shm"):
             try:
-                os.remove(file)
-            except Exception:
+                os.remove(checkpoint_path + suffix)
+            except FileNotFoundError:
                 pass
-        try:
-            os.rmdir(temp_dir)
-        except Exception:
-            pass
-
-        page.quit()
+    return failed
 
 
 if __name__ == "__main__":
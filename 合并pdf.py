@@ -1,8 +1,7 @@
 import os
-from PIL import Image
 from pathlib import Path
-from reportlab.pdfgen import canvas
-import glob
+
+from image_pdf import ImagePDFWriter
 
 
 class PDFGenerator:
@@ -32,34 +31,20 @@ class PDFGenerator:
                 print("No images found!")
                 return
 
-            # Create PDF without specifying page size
-            c = canvas.Canvas(self.output_file)
             total_images = len(image_paths)
 
-            for idx, img_path in enumerate(image_paths, 1):
-                try:
-                    # Get image size
-                    img = Image.open(img_path)
-                    img_width, img_height = img.size
-
-                    # Set page size to match image size
-                    c.setPageSize((img_width, img_height))
-
-                    # Draw image at full size at (0,0)
-                    c.drawImage(str(img_path), 0, 0, img_width, img_height)
-
-                    # New page unless it's the last image
-                    if idx < total_images:
-                        c.showPage()
+            # Each page takes the image's own size; JPEG bytes are embedded without re-encoding
+            with ImagePDFWriter(self.output_file, fit="native") as writer:
+                for idx, img_path in enumerate(image_paths, 1):
+                    try:
+                        writer.add_image(str(img_path))
 
-                    # Print progress
-                    print(f"Processing image {idx}/{total_images}")
+                        # Print progress
+                        print(f"Processing image {idx}/{total_images}")
 
-                except Exception as e:
-                    print(f"Error processing image {img_path}: {e}")
+                    except Exception as e:
+                        print(f"Error processing image {img_path}: {e}")
 
-            # Save PDF
-            c.save()
             print(f"\nPDF created successfully: {self.output_file}")
 
         except Exception as e:
@@ -1,9 +1,16 @@
 import os
 import math
+import sqlite3
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from PIL import Image
 import xml.etree.ElementTree as ET
 from DrissionPage import ChromiumPage, ChromiumOptions
+
+from retry_policy import request_with_retry
 #1.0版本
 
 def get_dzi_info(url):
@@ -65,37 +72,87 @@ def generate_tile_url(base_url, level, col, row, format):
     return f"{base_url}{level}/{col}_{row}.{format}"
 
 
-def download_tile(url, output_dir, failed_urls):
-    """下载单个瓦片，若不存在则跳过"""
+class TileManifest:
+    """基于 SQLite 的瓦片状态表，按 level/col/row 记录 pending/ok/404/error"""
+
+    # 这些状态在续传时不再请求；error 属于临时错误，会重新下载
+    DONE_STATES = ('ok', '404')
+
+    def __init__(self, db_path='tile_manifest.db'):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS tiles ('
+            ' level INTEGER NOT NULL, col INTEGER NOT NULL, row INTEGER NOT NULL,'
+            ' status TEXT NOT NULL DEFAULT \'pending\', bytes INTEGER NOT NULL DEFAULT 0,'
+            ' attempts INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL DEFAULT 0,'
+            ' PRIMARY KEY (level, col, row))'
+        )
+        self.conn.commit()
+
+    def register(self, level, cols, rows):
+        """登记整层的瓦片，已存在的记录保持原状态"""
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO tiles (level, col, row) VALUES (?, ?, ?)',
+            ((level, col, row) for col in range(cols) for row in range(rows))
+        )
+        self.conn.commit()
+
+    def pending(self, level):
+        """返回仍需下载的 (col, row) 列表"""
+        placeholders = ','.join('?' * len(self.DONE_STATES))
+        cursor = self.conn.execute(
+            f'SELECT col, row FROM tiles WHERE level = ? AND status NOT IN ({placeholders}) ORDER BY col, row',
+            (level, *self.DONE_STATES)
+        )
+        return cursor.fetchall()
+
+    def record(self, level, col, row, status, size=0):
+        """记录一次下载结果并累加尝试次数"""
+        self.conn.execute(
+            'UPDATE tiles SET status = ?, bytes = ?, attempts = attempts + 1, updated_at = ?'
+            ' WHERE level = ? AND col = ? AND row = ?',
+            (status, size, time.time(), level, col, row)
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def summary(self, level):
+        cursor = self.conn.execute('SELECT status, COUNT(*) FROM tiles WHERE level = ? GROUP BY status', (level,))
+        return dict(cursor.fetchall())
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def download_tile(url, tile_path):
+    """下载单个瓦片并原子写入，返回 (状态, 字节数)；状态为 ok / 404 / error"""
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
                       "Chrome/78.0.3904.97 Safari/537.36",
         "Referer": "https://www.dpm.org.cn"
     }
 
-    if url in failed_urls:
-        print(f"跳过已失败的瓦片：{url}")
-        return False
-
     try:
-        response = requests.get(url, headers=headers)
+        response = request_with_retry(requests, url, headers=headers, timeout=(10, 30))
         if response.status_code == 404:
             print(f"瓦片不存在，跳过：{url}")
-            failed_urls.add(url)
-            return False
+            return '404', 0
         response.raise_for_status()
 
-        tile_name = url.split("/")[-1]
-        tile_path = os.path.join(output_dir, tile_name)
-        with open(tile_path, 'wb') as f:
+        # 先写临时文件再替换，中断时不会留下半截瓦片
+        temp_path = tile_path + '.part'
+        with open(temp_path, 'wb') as f:
             f.write(response.content)
-        print(f"下载成功：{tile_name}")
-        return True
+        os.replace(temp_path, tile_path)
+        print(f"下载成功：{os.path.basename(tile_path)}")
+        return 'ok', len(response.content)
 
     except requests.exceptions.RequestException as e:
         print(f"下载失败：{url} - 错误：{e}")
-        failed_urls.add(url)
-        return False
+        return 'error', 0
 
 
 def load_tile(x, y, output_dir):
@@ -124,6 +181,59 @@ def stitch_tiles(output_dir, tile_size, num_cols, num_rows, final_width, final_h
     print("图像拼接完成，保存为 stitched_image.png")
 
 
+def _write_png_chunk(f, chunk_type, data):
+    """写入一个 PNG 数据块（长度 + 类型 + 数据 + CRC）"""
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def stitch_tiles_streaming(output_dir, tile_size, num_cols, num_rows, final_width, final_height,
+                           output_path='stitched_image.png'):
+    """按瓦片行逐条拼接并直接写入 PNG，内存峰值只有一条瓦片行的大小"""
+    compressor = zlib.compressobj(6)
+    with open(output_path, 'wb') as f, ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 位 RGB，无隔行扫描
+        _write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', final_width, final_height, 8, 2, 0, 0, 0))
+
+        stride = final_width * 3
+        for y in range(num_rows):
+            band_top = y * tile_size
+            band_height = min(tile_size, final_height - band_top)
+            if band_height <= 0:
+                break
+
+            band = Image.new('RGB', (final_width, band_height))
+
+            def paste_tile(x):
+                tile = load_tile(x, y, output_dir)
+                if tile:
+                    with tile:
+                        band.paste(tile, (x * tile_size, 0))
+
+            # 同一行的瓦片并行解码，各自写入条带中互不重叠的区域
+            list(executor.map(paste_tile, range(num_cols)))
+
+            raw = band.tobytes()
+            band.close()
+            # 每条扫描线前加过滤类型字节 0（None）
+            lines = bytearray()
+            for i in range(band_height):
+                lines.append(0)
+                lines += raw[i * stride:(i + 1) * stride]
+            data = compressor.compress(bytes(lines))
+            if data:
+                _write_png_chunk(f, b'IDAT', data)
+            print(f"已写入第 {y + 1}/{num_rows} 行瓦片", end='\r')
+
+        _write_png_chunk(f, b'IDAT', compressor.flush())
+        _write_png_chunk(f, b'IEND', b'')
+
+    print(f"\n图像拼接完成，保存为 {output_path}")
+
+
 def main():
     url = 'https://minghuaji.dpm.org.cn/paint/appreciate?id=d7b091dfc44a403d88da9f521b601d9f'
     dzi_data = get_dzi_info(url)
@@ -138,27 +248,30 @@ def main():
         os.makedirs(output_dir, exist_ok=True)
 
         tile_size, width, height = parse_dzi(dzi_file)
-        failed_urls_file = "failed_urls.txt"
-        failed_urls = set()
-        if os.path.exists(failed_urls_file):
-            with open(failed_urls_file, 'r', encoding='utf-8') as f:
-                failed_urls = set([line.strip() for line in f.readlines()])
 #level根据自己情况修改
         level = 15
         cols = math.ceil(width / tile_size)
         rows = math.ceil(height / tile_size)
 
-        print(f"开始下载缩放级别 {level} 的瓦片...")
-        for col in range(cols):
-            for row in range(rows):
-                url = generate_tile_url(base_url, level, col, row, "png")
-                download_tile(url, output_dir, failed_urls)
-
-        with open(failed_urls_file, 'w', encoding='utf-8') as f:
-            for url in failed_urls:
-                f.write(url + "\n")
+        # 瓦片状态表，续传时只处理 pending/error 的瓦片
+        manifest = TileManifest(os.path.join(output_dir, "tile_manifest.db"))
+        manifest.register(level, cols, rows)
+        todo = manifest.pending(level)
 
-        stitch_tiles(output_dir, tile_size, cols, rows, width, height)
+        print(f"开始下载缩放级别 {level} 的瓦片，剩余 {len(todo)}/{cols * rows} 个...")
+        try:
+            for index, (col, row) in enumerate(todo, 1):
+                url = generate_tile_url(base_url, level, col, row, "png")
+                status, size = download_tile(url, os.path.join(output_dir, f"{col}_{row}.png"))
+                manifest.record(level, col, row, status, size)
+                if index % 100 == 0:
+                    manifest.commit()
+        finally:
+            print("瓦片状态：", manifest.summary(level))
+            manifest.close()
+
+        # 流式拼接，避免整幅画布常驻内存
+        stitch_tiles_streaming(output_dir, tile_size, cols, rows, width, height)
     else:
         print("未获取到有效的 DZI 信息，无法生成文件。请检查链接的合法性或网络连接。")
 
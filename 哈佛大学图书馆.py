@@ -1,38 +1,170 @@
 import os
+from io import BytesIO
 from datetime import datetime
 from tqdm import tqdm
 import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
 from playwright.sync_api import sync_playwright
-#1.2版本，读取txt的数字id，更方便下载
 
-# 定义图片下载函数
-def download_image(image_id, image_number, url_template, folder_name):
+from retry_policy import RetryPolicy, request_with_retry
+#1.3版本，优先用连接池直接下载 IIIF 图片，只有必要时才启动一次浏览器
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36"
+
+FULL_IMAGE_SUFFIX = "/full/full/0/default.jpg"
+
+retry_policy = RetryPolicy()
+
+
+# 创建带连接池的会话，所有线程复用 keep-alive 连接
+def create_session(pool_size, user_agent=USER_AGENT, cookies=None):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"User-Agent": user_agent})
+    for cookie in cookies or []:
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
+    return session
+
+
+# 只启动一次浏览器，拿到 Cookie 和 UA 后交给 HTTP 会话使用
+def fetch_browser_credentials(sample_url):
     with sync_playwright() as playwright:
+        browser = playwright.chromium.launch(headless=True)
         try:
-            # 启动浏览器并创建上下文
-            browser = playwright.chromium.launch(headless=True)
-            context = browser.new_context(
-                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36"
-            )
+            context = browser.new_context(user_agent=USER_AGENT)
             page = context.new_page()
+            page.goto(sample_url, wait_until="domcontentloaded", timeout=120000)
+            user_agent = page.evaluate("() => navigator.userAgent")
+            cookies = context.cookies()
+        finally:
+            browser.close()
+    return user_agent, cookies
 
-            # 去除换行符和空白字符
-            image_id = image_id.strip()
-            image_url = url_template.format(image_id)
-            response = page.goto(image_url, wait_until="domcontentloaded", timeout=120000)  # 增加超时时间
-            image_bytes = response.body()
-
-            # 确保文件名不包含非法字符，使用自定义的序号命名文件
-            image_path = os.path.join(folder_name, f"{image_number}.jpg")
-            with open(image_path, "wb") as f:
-                f.write(image_bytes)
 
-            print(f"Image {image_id} downloaded successfully as {image_number}.jpg.")
-        except Exception as e:
-            print(f"Error downloading image {image_id}: {e}")
+# 读取 IIIF info.json，失败、不是 JSON（如登录页/错误页）或缺少宽高时返回 None，交给整图下载
+def fetch_info(session, image_base):
+    try:
+        response = request_with_retry(session, f"{image_base}/info.json", retry_policy, timeout=(10, 30))
+        if response.status_code != 200:
+            return None
+        info = response.json()
+        info["width"], info["height"] = int(info["width"]), int(info["height"])
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+        return None
+    return info
+
+
+# 分区并发下载，按原始像素位置拼回（不做任何缩放），单个分区失败只重试该分区
+def download_regions(session, image_base, width, height, region_size, region_executor):
+    def fetch_region(x, y, w, h):
+        region_url = f"{image_base}/{x},{y},{w},{h}/full/0/default.jpg"
+        response = request_with_retry(session, region_url, retry_policy, timeout=(10, 60))
+        response.raise_for_status()
+        region = Image.open(BytesIO(response.content))
+        region.load()
+        return x, y, region
+
+    regions = [
+        (x, y, min(region_size, width - x), min(region_size, height - y))
+        for y in range(0, height, region_size) for x in range(0, width, region_size)
+    ]
+    canvas = Image.new("RGB", (width, height))
+    futures = [region_executor.submit(fetch_region, *region) for region in regions]
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            x, y, region = future.result()
+            with region:
+                canvas.paste(region, (x, y))
+    except BaseException:
+        # 任一分区失败即放弃整张图，取消尚未开始的分区请求
+        for future in futures:
+            future.cancel()
+        raise
+    return canvas
+
+
+# 通过 HTTP 会话下载单张图片，返回状态码（网络错误时返回 None）
+def download_image(session, image_id, image_number, base_template, folder_name, region_size=None, region_executor=None):
+    image_id = image_id.strip()
+    image_base = base_template.format(image_id)
+
+    # 分区模式：大图拆成多个 IIIF 区域并发下载，保存为无损 PNG
+    if region_size and region_executor:
+        info = fetch_info(session, image_base)
+        if info and info["width"] * info["height"] > 4 * region_size * region_size:
+            try:
+                canvas = download_regions(session, image_base, info["width"], info["height"],
+                                          region_size, region_executor)
+            except (requests.exceptions.RequestException, OSError) as e:
+                print(f"Error downloading regions of image {image_id}: {e}")
+                return None
+            image_path = os.path.join(folder_name, f"{image_number}.png")
+            canvas.save(image_path + ".part", "PNG")
+            os.replace(image_path + ".part", image_path)
+            return 200
+
+    image_url = image_base + FULL_IMAGE_SUFFIX
+    try:
+        response = request_with_retry(session, image_url, retry_policy, timeout=(10, 120))
+    except requests.exceptions.RequestException as e:
+        print(f"Error downloading image {image_id}: {e}")
+        return None
+
+    if response.status_code != 200:
+        return response.status_code
+
+    # 先写临时文件再改名，中断时不会留下残缺图片
+    image_path = os.path.join(folder_name, f"{image_number}.jpg")
+    with open(image_path + ".part", "wb") as f:
+        f.write(response.content)
+    os.replace(image_path + ".part", image_path)
+    return 200
+
+
+# 并发下载一批图片，返回失败的 (id, 序号) 列表
+def download_batch(session, jobs, base_template, folder_name, max_workers, desc, region_size=None):
+    failed = []
+    # 分区请求使用独立的线程池，避免与外层图片任务互相等待
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as region_executor:
+        futures = {
+            executor.submit(download_image, session, image_id, number, base_template, folder_name,
+                            region_size, region_executor): (image_id, number)
+            for image_id, number in jobs
+        }
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc=desc):
+            if future.result() != 200:
+                failed.append(futures[future])
+    return failed
+
+
+# 确实需要浏览器时：复用同一个浏览器，每张图片用一个轻量的新上下文
+def download_with_browser(jobs, base_template, folder_name):
+    failed = []
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch(headless=True)
+        try:
+            for image_id, image_number in tqdm(jobs, desc="Downloading via browser"):
+                context = browser.new_context(user_agent=USER_AGENT)
+                try:
+                    response = context.request.get(base_template.format(image_id.strip()) + FULL_IMAGE_SUFFIX, timeout=120000)
+                    if response.ok:
+                        with open(os.path.join(folder_name, f"{image_number}.jpg"), "wb") as f:
+                            f.write(response.body())
+                    else:
+                        failed.append((image_id, image_number))
+                except Exception as e:
+                    print(f"Error downloading image {image_id}: {e}")
+                    failed.append((image_id, image_number))
+                finally:
+                    context.close()
         finally:
-            # 关闭浏览器
             browser.close()
+    return failed
 
 
 # 自动创建新文件夹（根据当前时间戳）
@@ -57,9 +189,9 @@ def read_ids_from_file(filename="ids.txt"):
 
 
 # 主函数
-def run():
-    # 配置 URL 模板
-    url_template = "https://ids.lib.harvard.edu/ids/iiif/{}/full/full/0/default.jpg"
+def run(max_workers=16, region_size=None):
+    # 配置 IIIF 图片地址模板；region_size 例如 2048 时，大图按区域并发下载
+    base_template = "https://ids.lib.harvard.edu/ids/iiif/{}"
 
     # 从文件中读取 ID 列表
     ids = read_ids_from_file()
@@ -75,14 +207,30 @@ def run():
     folder_name = create_new_folder()
 
     print(f"Starting download of {len(ids)} images.")
-
-    # 使用多进程下载图片
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-        list(tqdm(
-            executor.map(download_image, ids, range(1, len(ids) + 1), [url_template]*len(ids), [folder_name]*len(ids)),
-            total=len(ids),
-            desc="Downloading images"
-        ))
+    jobs = list(zip(ids, range(1, len(ids) + 1)))
+
+    # 快速路径：直接通过连接池下载
+    # 图片线程和分区线程共用同一个连接池
+    with create_session(max_workers * 2) as session:
+        failed = download_batch(session, jobs, base_template, folder_name, max_workers, "Downloading images",
+                                region_size)
+
+    # 有失败时，用浏览器拿一次 Cookie/UA，再走 HTTP 重试
+    if failed:
+        print(f"{len(failed)} images failed over plain HTTP, retrying with browser cookies...")
+        # 只打开很小的 info.json 取 Cookie，不在浏览器里再传一次整张原图
+        user_agent, cookies = fetch_browser_credentials(base_template.format(failed[0][0].strip()) + "/info.json")
+        with create_session(max_workers * 2, user_agent, cookies) as session:
+            failed = download_batch(session, failed, base_template, folder_name, max_workers, "Retrying with cookies",
+                                    region_size)
+
+    # 仍然失败的才交给浏览器逐个下载
+    if failed:
+        print(f"{len(failed)} images still failing, falling back to the browser...")
+        failed = download_with_browser(failed, base_template, folder_name)
+
+    if failed:
+        print(f"Failed to download {len(failed)} images: {[image_id for image_id, _ in failed]}")
 
 
 if __name__ == "__main__":
@@ -1,8 +1,8 @@
 import os
-from PIL import Image, UnidentifiedImageError
-from fpdf import FPDF
 from tqdm import tqdm  # 导入 tqdm 用于进度条
 
+from image_pdf import images_to_pdf
+
 
 folder_path = "file_path"  # 将此路径替换为实际的图片文件夹路径
 #E:\\2025\\hathitrust_images
@@ -12,18 +12,9 @@ image_files = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if
 
 # Step 2: 将图片合并为一个PDF
 if image_files:
-    pdf = FPDF()
-    for image_file in tqdm(image_files, desc="合并图片为 PDF", unit="文件"):  # 使用 tqdm 添加进度条
-        try:
-            with Image.open(image_file) as image:
-                pdf.add_page()
-                pdf.image(image_file, 0, 0, 210, 297)  # 以 A4 大小插入图片
-        except (IOError, UnidentifiedImageError) as e:
-            print(f"Error processing file {image_file}: {e}")
-            continue
-
     output_pdf = "output.pdf"
-    pdf.output(output_pdf)
+    # 逐页写入磁盘，JPEG 直接嵌入不重新编码；按比例缩放到 A4 页面
+    images_to_pdf(tqdm(image_files, desc="合并图片为 PDF", unit="文件"), output_pdf, fit="a4")  # 使用 tqdm 添加进度条
 
     print(f"PDF 文件已生成: {output_pdf}")
 else:
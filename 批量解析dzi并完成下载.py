@@ -1,12 +1,15 @@
+import io
 import os
 import asyncio
-import requests
+import aiohttp
 import xml.etree.ElementTree as ET
 from PIL import Image
-from fpdf import FPDF
 from PyPDF2 import PdfMerger
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 import re
+from concurrent.futures import ThreadPoolExecutor
+
+from image_pdf import ImagePDFWriter
 
 # DZI文件模板
 dzi_template = '''<?xml version="1.0" encoding="UTF-8"?>
@@ -16,130 +19,236 @@ dzi_template = '''<?xml version="1.0" encoding="UTF-8"?>
 </Image>'''
 
 
-async def fetch_tile_sources_from_page(page_url, file_index, output_dir, tile_level=0):
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        context = await browser.new_context()
-        page = await context.new_page()
-        print(f"Loading {page_url}...")
-        await page.goto(page_url)
-        await page.wait_for_timeout(5000)
-
-        scripts = await page.evaluate(""" 
-            () => {
-                return Array.from(document.querySelectorAll('script')).map(script => script.textContent);
-            }
-        """)
-
-        tile_sources = {}
-        for script_content in scripts:
-            if "tileSources" in script_content:
-                tile_sources_match = re.search(r'tileSources:\s*{\s*Image:\s*{([^}]*)}', script_content)
-                if tile_sources_match:
-                    tile_sources_str = tile_sources_match.group(1)
-
-                    # 提取字段，并排除 'Size'
-                    fields = re.findall(r'(\w+):\s*["\']?([^"\',\s]+)["\']?', tile_sources_str)
-                    for key, value in fields:
-                        if key.lower() != "size":  # 排除 Size 字段
-                            tile_sources[key] = value
-
-                    print("Extracted tileSources Data:")
-                    for key, value in tile_sources.items():
-                        print(f"{key}: {value}")
-
-                    # 使用修正后的 DZI 模板构建内容
-                    dzi_content = dzi_template.format(
-                        TileSize=tile_sources.get("TileSize", "0"),
-                        Overlap=tile_sources.get("Overlap", "0"),
-                        Format=tile_sources.get("Format", "png"),
-                        xmlns=tile_sources.get("xmlns", "https://schemas.microsoft.com/deepzoom/2009"),
-                        Url=tile_sources.get("Url", "").rstrip('/') + f"/{tile_level}/",
-                        Width=tile_sources.get("Width", "0"),
-                        Height=tile_sources.get("Height", "0")
+# 提取元数据时不需要的资源类型，直接拦截
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+
+class BrowserPool:
+    """长驻的 Chromium 浏览器，多个标签页并发提取 tileSources"""
+
+    def __init__(self, max_tabs=4, timeout=30000):
+        self.max_tabs = max_tabs
+        self.timeout = timeout
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._semaphore = asyncio.Semaphore(max_tabs)
+
+    async def __aenter__(self):
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(headless=True)
+        self._context = await self._browser.new_context()
+        await self._context.route("**/*", self._block_heavy_resources)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._context.close()
+        await self._browser.close()
+        await self._playwright.stop()
+
+    @staticmethod
+    async def _block_heavy_resources(route):
+        if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def get_scripts(self, page_url):
+        """打开页面，等到包含 tileSources 的脚本出现后返回所有脚本内容"""
+        async with self._semaphore:
+            page = await self._context.new_page()
+            try:
+                print(f"Loading {page_url}...")
+                await page.goto(page_url, wait_until="domcontentloaded", timeout=self.timeout)
+                try:
+                    await page.wait_for_function(
+                        "() => Array.from(document.scripts).some(s => s.textContent.includes('tileSources'))",
+                        timeout=self.timeout
                     )
-
-                    # 保存 DZI 文件
-                    dzi_filename = os.path.join(output_dir, f"dzi_{file_index}.dzi")
-                    with open(dzi_filename, 'w', encoding='utf-8') as f:
-                        f.write(dzi_content)
-                    print(f"Wrote to {dzi_filename}")
-
-                else:
-                    print("tileSources data not found in the script.")
-                break
-
-        await browser.close()
-
-
-async def download_tiles(dzi_file, output_dir, tile_level=0):
-    """Download all tiles for a given DZI file."""
-    tree = ET.parse(dzi_file)
-    root = tree.getroot()
-
-    width = int(root.find('{https://schemas.microsoft.com/deepzoom/2009}Size').get('Width'))
-    height = int(root.find('{https://schemas.microsoft.com/deepzoom/2009}Size').get('Height'))
-    tile_size = int(root.get('TileSize') or 510)
-    base_url = root.get('Url').rstrip('/')  # 去掉末尾的斜杠
-
-    columns = (width + tile_size - 1) // tile_size
-    rows = (height + tile_size - 1) // tile_size
+                except PlaywrightTimeoutError:
+                    print(f"tileSources did not appear on {page_url}")
+                return await page.evaluate(
+                    "() => Array.from(document.querySelectorAll('script')).map(script => script.textContent)"
+                )
+            finally:
+                await page.close()
+
+
+async def fetch_tile_sources_from_page(page_url, file_index, output_dir, tile_level=0, pool=None):
+    if pool is None:
+        async with BrowserPool(max_tabs=1) as own_pool:
+            return await fetch_tile_sources_from_page(page_url, file_index, output_dir, tile_level, own_pool)
+
+    scripts = await pool.get_scripts(page_url)
+    write_dzi_from_scripts(scripts, file_index, output_dir, tile_level)
+
+
+def write_dzi_from_scripts(scripts, file_index, output_dir, tile_level=0):
+    """从页面脚本中解析 tileSources 并写出 DZI 文件"""
+    tile_sources = {}
+    for script_content in scripts:
+        if "tileSources" in script_content:
+            tile_sources_match = re.search(r'tileSources:\s*{\s*Image:\s*{([^}]*)}', script_content)
+            if tile_sources_match:
+                tile_sources_str = tile_sources_match.group(1)
+
+                # 提取字段，并排除 'Size'
+                fields = re.findall(r'(\w+):\s*["\']?([^"\',\s]+)["\']?', tile_sources_str)
+                for key, value in fields:
+                    if key.lower() != "size":  # 排除 Size 字段
+                        tile_sources[key] = value
+
+                print("Extracted tileSources Data:")
+                for key, value in tile_sources.items():
+                    print(f"{key}: {value}")
+
+                # 使用修正后的 DZI 模板构建内容
+                dzi_content = dzi_template.format(
+                    TileSize=tile_sources.get("TileSize", "0"),
+                    Overlap=tile_sources.get("Overlap", "0"),
+                    Format=tile_sources.get("Format", "png"),
+                    xmlns=tile_sources.get("xmlns", "https://schemas.microsoft.com/deepzoom/2009"),
+                    Url=tile_sources.get("Url", "").rstrip('/') + f"/{tile_level}/",
+                    Width=tile_sources.get("Width", "0"),
+                    Height=tile_sources.get("Height", "0")
+                )
+
+                # 保存 DZI 文件
+                dzi_filename = os.path.join(output_dir, f"dzi_{file_index}.dzi")
+                with open(dzi_filename, 'w', encoding='utf-8') as f:
+                    f.write(dzi_content)
+                print(f"Wrote to {dzi_filename}")
+
+            else:
+                print("tileSources data not found in the script.")
+            break
+
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def create_tile_session(max_in_flight=16, timeout=30):
+    """创建共享的 aiohttp 会话，每个主机一个连接池"""
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=max_in_flight)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+def read_dzi_descriptor(dzi_file):
+    """读取 DZI 文件中的 TileSize / Overlap / Format / Size / Url"""
+    root = ET.parse(dzi_file).getroot()
+    # 页面里给出的 xmlns 可能是 http 也可能是 https，这里按本地标签名查找
+    size = next(el for el in root.iter() if el.tag.rsplit('}', 1)[-1] == 'Size')
+    return {
+        'width': int(size.get('Width')),
+        'height': int(size.get('Height')),
+        'tile_size': int(root.get('TileSize') or 510),
+        'overlap': int(root.get('Overlap') or 0),
+        'format': root.get('Format') or 'png',
+        'url': root.get('Url').rstrip('/'),  # 去掉末尾的斜杠
+    }
+
+
+def tile_grid(descriptor):
+    """返回瓦片的列数和行数"""
+    tile_size = descriptor['tile_size']
+    columns = (descriptor['width'] + tile_size - 1) // tile_size
+    rows = (descriptor['height'] + tile_size - 1) // tile_size
+    return columns, rows
+
+
+async def download_tiles(dzi_file, output_dir, tile_level=0, session=None, max_in_flight=16, timeout=30):
+    """Download all tiles for a given DZI file.
+
+    Returns the DZI descriptor and a dict mapping (x, y) to the tile bytes.
+    """
+    descriptor = read_dzi_descriptor(dzi_file)
+    base_url = descriptor['url']
+    tile_format = descriptor['format']
+    columns, rows = tile_grid(descriptor)
+    tiles = {}
     failed_tiles = []
 
     os.makedirs(output_dir, exist_ok=True)
 
-    for x in range(columns):
-        for y in range(rows):
-            tile_url = f"{base_url}/{x}_{y}.png"
-            tile_path = os.path.join(output_dir, f"{x}_{y}.png")
-
-            try:
-                response = await asyncio.to_thread(requests.get, tile_url)
-                response.raise_for_status()
-                with open(tile_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"Downloaded tile: {tile_url}")
-            except Exception as e:
-                print(f"Failed to download {tile_url}: {e}")
-                failed_tiles.append(tile_url)
+    own_session = session is None
+    if own_session:
+        session = create_tile_session(max_in_flight, timeout)
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def fetch(x, y):
+        tile_url = f"{base_url}/{x}_{y}.{tile_format}"
+        tile_path = os.path.join(output_dir, f"{x}_{y}.{tile_format}")
+        try:
+            async with semaphore:
+                async with session.get(tile_url) as response:
+                    response.raise_for_status()
+                    data = await response.read()
+            # 写文件放到线程里，不阻塞事件循环
+            await asyncio.to_thread(_write_file, tile_path, data)
+            tiles[(x, y)] = data
+            print(f"Downloaded tile: {tile_url}")
+        except Exception as e:
+            print(f"Failed to download {tile_url}: {e}")
+            failed_tiles.append(tile_url)
+
+    try:
+        await asyncio.gather(*(fetch(x, y) for x in range(columns) for y in range(rows)))
+    finally:
+        if own_session:
+            await session.close()
 
     if failed_tiles:
         print("Some tiles could not be downloaded:")
         for failed_tile in failed_tiles:
             print(f"  - {failed_tile}")
 
-    return width, height
-
-
-def synthesize_image(output_dir, width, height):
-    """Synthesize tiles into a single image."""
-    tile_size = 510  # Adjust as per your tile size
-    synthesized_image = Image.new('RGB', (width, height))
-
-    columns = (width + tile_size - 1) // tile_size
-    rows = (height + tile_size - 1) // tile_size
-
-    for x in range(columns):
-        for y in range(rows):
-            tile_path = os.path.join(output_dir, f"{x}_{y}.png")
-            if os.path.exists(tile_path):
-                tile_image = Image.open(tile_path)
-                position_x = x * tile_size
-                position_y = y * tile_size
-                synthesized_image.paste(tile_image, (position_x, position_y))
+    return descriptor, tiles
+
+
+def _paste_tile(canvas, descriptor, x, y, data):
+    """Decode one tile, crop its overlap margins and paste it into its own region of the canvas"""
+    width, height = descriptor['width'], descriptor['height']
+    tile_size = descriptor['tile_size']
+    overlap = descriptor['overlap']
+    position_x = x * tile_size
+    position_y = y * tile_size
+    left = overlap if x > 0 else 0
+    top = overlap if y > 0 else 0
+    with Image.open(io.BytesIO(data)) as tile_image:
+        box = (left, top,
+               min(left + tile_size, left + width - position_x, tile_image.width),
+               min(top + tile_size, top + height - position_y, tile_image.height))
+        canvas.paste(tile_image.crop(box), (position_x, position_y))
+
+
+def synthesize_image(descriptor, tiles, workers=None):
+    """Synthesize in-memory tiles into a single image.
+
+    DZI tiles carry `Overlap` extra pixels on every inner edge, so the
+    margins are cropped before each tile is pasted at x * TileSize, y * TileSize.
+    Tiles are decoded and pasted by a thread pool; Pillow releases the GIL while
+    decoding and every tile writes to a disjoint region of the canvas.
+    """
+    synthesized_image = Image.new('RGB', (descriptor['width'], descriptor['height']))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(_paste_tile, synthesized_image, descriptor, x, y, data)
+                   for (x, y), data in tiles.items()]
+        for future in futures:
+            future.result()
 
     return synthesized_image
 
 
 def save_image_as_pdf(image, pdf_path):
     """Save the synthesized image as a PDF."""
-    pdf = FPDF()
-    pdf.add_page()
-    temp_path = "temp_image.jpg"
-    image.save(temp_path, "JPEG")
-    pdf.image(temp_path, x=0, y=0, w=pdf.w, h=pdf.h)
-    pdf.output(pdf_path)
-    os.remove(temp_path)
+    # Encode once in memory and embed the JPEG bytes directly; no temp file round-trip
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=95)
+    with ImagePDFWriter(pdf_path, fit="a4") as pdf:
+        pdf.add_jpeg(buffer.getvalue())
     print(f"PDF saved successfully: {pdf_path}")
 
 
@@ -163,21 +272,33 @@ async def main_fetch():
     # 获取用户输入的层级，不知道可以填10测试一下，参数对了下载碎图便可以自动构造
     tile_level = int(input("请输入图像的层级："))
 
-    for index, url in enumerate(urls, start=1):
-        page_output_dir = os.path.join(output_directory, f"DZI_{index}")
-        os.makedirs(page_output_dir, exist_ok=True)
-
-        # 添加自定义瓦片参数
-        await fetch_tile_sources_from_page(url, index, page_output_dir, tile_level)
-
-        dzi_filename = os.path.join(page_output_dir, f"dzi_{index}.dzi")
-        if os.path.exists(dzi_filename):
-            width, height = await download_tiles(dzi_filename, page_output_dir, tile_level)
-            synthesized_image = synthesize_image(page_output_dir, width, height)
-
-            pdf_path = os.path.join(page_output_dir, f"synthesized_{index}.pdf")
-            save_image_as_pdf(synthesized_image, pdf_path)
-            pdf_paths.append(pdf_path)
+    page_output_dirs = {}
+    for index in range(1, len(urls) + 1):
+        page_output_dirs[index] = os.path.join(output_directory, f"DZI_{index}")
+        os.makedirs(page_output_dirs[index], exist_ok=True)
+
+    # 复用同一个浏览器，多标签页并发提取所有页面的 tileSources
+    async with BrowserPool(max_tabs=4) as pool:
+        results = await asyncio.gather(*(
+            fetch_tile_sources_from_page(url, index, page_output_dirs[index], tile_level, pool)
+            for index, url in enumerate(urls, start=1)
+        ), return_exceptions=True)
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            print(f"Failed to extract tileSources from {url}: {result}")
+
+    # 所有页面共用一个会话，同一主机的连接可以复用
+    async with create_tile_session() as session:
+        for index in range(1, len(urls) + 1):
+            page_output_dir = page_output_dirs[index]
+            dzi_filename = os.path.join(page_output_dir, f"dzi_{index}.dzi")
+            if os.path.exists(dzi_filename):
+                descriptor, tiles = await download_tiles(dzi_filename, page_output_dir, tile_level, session=session)
+                synthesized_image = synthesize_image(descriptor, tiles)
+
+                pdf_path = os.path.join(page_output_dir, f"synthesized_{index}.pdf")
+                save_image_as_pdf(synthesized_image, pdf_path)
+                pdf_paths.append(pdf_path)
 
     merged_pdf_path = os.path.join(output_directory, "merged_output.pdf")
     merge_pdfs(pdf_paths, merged_pdf_path)
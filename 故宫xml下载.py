@@ -3,9 +3,28 @@ import aiohttp
 import os
 from PIL import Image
 import io
+import math
+import xml.etree.ElementTree as ET
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import re
+from urllib.parse import urlparse
+
+from retry_policy import RetryPolicy, async_get_with_retry
+
+
+class DownloadJob:
+    """Per-image state for one URL in a batch run"""
+
+    def __init__(self, index, url, url_info, tile_size):
+        self.index = index
+        self.url = url
+        self.url_info = url_info
+        self.tile_size = tile_size
+        self.total_tiles = 0
+        self.done_tiles = 0
+        self.status = 'pending'
 
 
 class ImageDownloader:  #用于下载故宫博物院后缀我xml的缩放图
@@ -18,10 +37,19 @@ class ImageDownloader:  #用于下载故宫博物院后缀我xml的缩放图
         self.base_url = "https://www.dpm.org.cn"
         self.output_dir = "dpm_tiles"
         self.tile_size = 256
-        self.current_url_info = None
         self.total_urls = 0
-        self.current_url_index = 0
         self.max_retries = 2
+        self.retry_policy = RetryPolicy(max_attempts=self.max_retries + 1)
+        self.max_probe = 1024
+        self.max_concurrent_fetches = 16
+        self.decode_workers = os.cpu_count() or 4
+        self.crop_chunk_rows = 512
+        self.max_concurrent_jobs = 3
+        self.max_requests_per_host = 32
+        self._host_slots = {}
+        self._jobs = []
+        self._descriptor_cache = {}
+        self._grid_cache = {}
 
     def extract_url_info(self, url):
         """Extract image information from URL"""
@@ -29,7 +57,8 @@ class ImageDownloader:  #用于下载故宫博物院后缀我xml的缩放图
         match = re.search(pattern, url)
         if match:
             return {
-                'path': f"/Uploads/tilegenerator/dest/files/image/{match.group(1)}/{match.group(2)}/{match.group(3)}/{match.group(4)}"
+                'path': f"/Uploads/tilegenerator/dest/files/image/{match.group(1)}/{match.group(2)}/{match.group(3)}/{match.group(4)}",
+                'xml_url': url
             }
         return None
 
@@ -45,91 +74,192 @@ class ImageDownloader:  #用于下载故宫博物院后缀我xml的缩放图
             print(f"Error loading URLs from file: {e}")
             return []
 
-    async def download_tile(self, session, x, y, level, retry_count=0):
-        """Download a single tile with retry logic"""
-        if not self.current_url_info:
-            return None
+    def host_slot(self, url):
+        """Semaphore shared by every job that talks to the same host"""
+        host = urlparse(url).netloc
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.max_requests_per_host)
+        return self._host_slots[host]
 
-        tile_url = f"{self.current_url_info['path']}_files/{level}/{x}_{y}.jpg"
+    async def download_tile(self, session, job, x, y, level):
+        """Download a single tile using the shared retry/backoff policy"""
+        tile_url = f"{job.url_info['path']}_files/{level}/{x}_{y}.jpg"
         full_url = self.base_url + tile_url
 
         try:
-            async with session.get(full_url) as response:
-                if response.status == 200:
-                    return await response.read()
-                if retry_count < self.max_retries:
-                    print(f"\nRetrying tile {x},{y} at level {level} (Attempt {retry_count + 2})")
-                    await asyncio.sleep(1)  # Wait before retry
-                    return await self.download_tile(session, x, y, level, retry_count + 1)
-                return None
-        except Exception as e:
-            if retry_count < self.max_retries:
-                print(f"\nRetrying tile {x},{y} at level {level} (Attempt {retry_count + 2})")
-                await asyncio.sleep(1)  # Wait before retry
-                return await self.download_tile(session, x, y, level, retry_count + 1)
+            # The host slot is taken per attempt, so a failing tile releases it while backing off
+            status, body = await async_get_with_retry(session, full_url, self.retry_policy,
+                                                      attempt_slot=lambda: self.host_slot(full_url))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             print(f"Error downloading tile {x},{y} at level {level}: {e}")
             return None
+        return body
 
-    async def test_level_validity(self, session, level):
-        """Test if the level exists by checking a few tiles"""
-        test_positions = [(0, 0), (0, 1), (1, 0), (1, 1)]
-        for x, y in test_positions:
-            tile_data = await self.download_tile(session, x, y, level)
-            if tile_data:
-                return True
-        return False
-
-    async def get_level_dimensions(self, session, level):
-        """Get dimensions for specific level by testing tiles"""
-        max_test = 100
-
-        async def check_tile(x, y):
-            tile_data = await self.download_tile(session, x, y, level)
-            return tile_data is not None
-
-        x_size = y_size = 0
-
-        print("Detecting image dimensions...")
-        for i in range(max_test):
-            x_exists = await check_tile(i, 0)
-            y_exists = await check_tile(0, i)
+    async def fetch_descriptor(self, session, job):
+        """Fetch and parse the DZI .xml descriptor for the job's image (cached per image)"""
+        path = job.url_info['path']
+        if path in self._descriptor_cache:
+            return self._descriptor_cache[path]
 
-            if not x_exists and x_size == 0:
-                x_size = i
-            if not y_exists and y_size == 0:
-                y_size = i
+        descriptor = None
+        xml_url = job.url_info.get('xml_url') or f"{self.base_url}{path}.xml"
+        try:
+            async with self.host_slot(xml_url), session.get(xml_url) as response:
+                if response.status == 200:
+                    root = ET.fromstring(await response.text())
+                    size = next(el for el in root.iter() if el.tag.rsplit('}', 1)[-1] == 'Size')
+                    width = int(size.get('Width'))
+                    height = int(size.get('Height'))
+                    descriptor = {
+                        'width': width,
+                        'height': height,
+                        'tile_size': int(root.get('TileSize', self.tile_size)),
+                        'overlap': int(root.get('Overlap', 0)),
+                        'format': root.get('Format', 'jpg'),
+                        'max_level': math.ceil(math.log2(max(width, height, 1))),
+                    }
+        except (aiohttp.ClientError, asyncio.TimeoutError, ET.ParseError, StopIteration, ValueError) as e:
+            print(f"Could not read descriptor {xml_url}: {e}")
+
+        self._descriptor_cache[path] = descriptor
+        return descriptor
+
+    @staticmethod
+    def level_size(descriptor, level):
+        """Pixel size of a Deep Zoom level (level max_level is full resolution)"""
+        scale = 2 ** (descriptor['max_level'] - level)
+        return math.ceil(descriptor['width'] / scale), math.ceil(descriptor['height'] / scale)
+
+    async def tile_exists(self, session, job, x, y, level):
+        """Lightweight existence probe: HEAD first, then a 1-byte ranged GET"""
+        tile_url = f"{self.base_url}{job.url_info['path']}_files/{level}/{x}_{y}.jpg"
+        try:
+            async with self.host_slot(tile_url):
+                async with session.head(tile_url, allow_redirects=True) as response:
+                    if response.status == 200:
+                        return True
+                    if response.status == 404:
+                        return False
+                async with session.get(tile_url, headers={'Range': 'bytes=0-0'}) as response:
+                    return response.status in (200, 206)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
 
-            if x_size != 0 and y_size != 0:
+    async def probe_axis_length(self, session, job, level, axis):
+        """Count tiles along one axis with concurrent exponential search plus binary search"""
+        def position(i):
+            return (i, 0) if axis == 'x' else (0, i)
+
+        if not await self.tile_exists(session, job, *position(0), level):
+            return 0
+
+        # Probe 1, 2, 4, ... concurrently to bracket the edge
+        bounds = []
+        step = 1
+        while step < self.max_probe:
+            bounds.append(step)
+            step *= 2
+        exists = await asyncio.gather(*(self.tile_exists(session, job, *position(i), level) for i in bounds))
+
+        low, high = 0, self.max_probe
+        for bound, found in zip(bounds, exists):
+            if found:
+                low = bound
+            else:
+                high = bound
                 break
 
-            print(f"Scanning dimensions... Current size: {i}x{i}", end='\r')
-
-        print(f"\nDetected image grid size: {x_size}x{y_size} tiles")
+        # Binary search between the last existing and first missing index
+        while high - low > 1:
+            mid = (low + high) // 2
+            if await self.tile_exists(session, job, *position(mid), level):
+                low = mid
+            else:
+                high = mid
+        return low + 1
+
+    async def test_level_validity(self, session, job, level):
+        """Test if the level exists, using the descriptor when available"""
+        descriptor = await self.fetch_descriptor(session, job)
+        if descriptor:
+            return 0 <= level <= descriptor['max_level']
+        tiles_x, tiles_y = await self.get_level_dimensions(session, job, level)
+        return tiles_x > 0 and tiles_y > 0
+
+    async def get_level_dimensions(self, session, job, level):
+        """Get the tile grid for a level from the descriptor, probing only as a fallback"""
+        key = (job.url_info['path'], level)
+        if key in self._grid_cache:
+            return self._grid_cache[key]
+
+        descriptor = await self.fetch_descriptor(session, job)
+        if descriptor:
+            level_width, level_height = self.level_size(descriptor, level)
+            x_size = math.ceil(level_width / descriptor['tile_size'])
+            y_size = math.ceil(level_height / descriptor['tile_size'])
+        else:
+            print(f"[URL {job.index + 1}] Detecting image dimensions...")
+            x_size, y_size = await asyncio.gather(
+                self.probe_axis_length(session, job, level, 'x'),
+                self.probe_axis_length(session, job, level, 'y')
+            )
+
+        print(f"[URL {job.index + 1}] Detected image grid size: {x_size}x{y_size} tiles")
+        self._grid_cache[key] = (x_size, y_size)
         return x_size, y_size
 
+    def _gradient_chunks(self, image):
+        """Yield (row_offset, gradient_magnitude) for horizontal bands of the image in float32.
+
+        Each band is read with a one-row halo so the central differences match
+        np.gradient over the whole image.
+        """
+        width, height = image.size
+        for start in range(0, height, self.crop_chunk_rows):
+            end = min(start + self.crop_chunk_rows, height)
+            halo_top = max(start - 1, 0)
+            halo_bottom = min(end + 1, height)
+            band = np.asarray(image.crop((0, halo_top, width, halo_bottom)), dtype=np.float32)
+            if band.ndim == 3:
+                # Convert to grayscale for edge detection
+                band = band.mean(axis=2, dtype=np.float32)
+
+            gradient_x = np.gradient(band, axis=1)
+            gradient_y = np.gradient(band, axis=0)
+            magnitude = np.sqrt(gradient_x * gradient_x + gradient_y * gradient_y)
+            yield start, magnitude[start - halo_top:end - halo_top]
+
     def precise_crop(self, image):
-        """Precisely crop the image to content edges using advanced edge detection"""
-        # Convert to numpy array
-        img_array = np.array(image)
+        """Precisely crop the image to content edges using advanced edge detection
+
+        Works on bands of `crop_chunk_rows` rows, so memory stays bounded by one
+        band rather than several full-size float64 copies of the canvas. The 90th
+        percentile is taken from a fine histogram and edges from per-row/column maxima.
+        """
+        width, height = image.size
+        if width < 2 or height < 2:
+            return image
 
-        if len(img_array.shape) == 3:
-            # Convert to grayscale for edge detection
-            gray_array = np.mean(img_array, axis=2)
-        else:
-            gray_array = img_array
+        # Largest possible central-difference magnitude for 8-bit data
+        max_magnitude = 255.0 * math.sqrt(2)
+        bins = 8192
+        histogram = np.zeros(bins, dtype=np.int64)
+        row_max = np.zeros(height, dtype=np.float32)
+        col_max = np.zeros(width, dtype=np.float32)
 
-        # Calculate gradients for edge detection
-        gradient_x = np.gradient(gray_array, axis=1)
-        gradient_y = np.gradient(gray_array, axis=0)
-        gradient_magnitude = np.sqrt(gradient_x ** 2 + gradient_y ** 2)
+        for start, magnitude in self._gradient_chunks(image):
+            histogram += np.histogram(magnitude, bins=bins, range=(0.0, max_magnitude))[0]
+            row_max[start:start + magnitude.shape[0]] = magnitude.max(axis=1)
+            np.maximum(col_max, magnitude.max(axis=0), out=col_max)
 
         # Find significant edges (adjust threshold as needed)
-        edge_threshold = np.percentile(gradient_magnitude, 90)
-        edges = gradient_magnitude > edge_threshold
+        cumulative = np.cumsum(histogram)
+        threshold_bin = int(np.searchsorted(cumulative, 0.9 * cumulative[-1]))
+        edge_threshold = (threshold_bin + 1) * max_magnitude / bins
 
         # Find the outermost significant edges
-        rows = np.where(np.any(edges, axis=1))[0]
-        cols = np.where(np.any(edges, axis=0))[0]
+        rows = np.where(row_max > edge_threshold)[0]
+        cols = np.where(col_max > edge_threshold)[0]
 
         if len(rows) == 0 or len(cols) == 0:
             return image
@@ -137,64 +267,125 @@ class ImageDownloader:  #用于下载故宫博物院后缀我xml的缩放图
         # Add a small buffer to ensure we don't crop too tightly
         buffer = 2
         top = max(rows[0] - buffer, 0)
-        bottom = min(rows[-1] + buffer, img_array.shape[0])
+        bottom = min(rows[-1] + buffer, height)
         left = max(cols[0] - buffer, 0)
-        right = min(cols[-1] + buffer, img_array.shape[1])
+        right = min(cols[-1] + buffer, width)
 
         return image.crop((left, top, right, bottom))
 
-    async def download_level(self, session, level, url_index):
+    @staticmethod
+    def decode_tile(tile_data, x, y, overlap, tile_size):
+        """Decode a tile to RGB and crop it to its own tile_size cell, dropping the overlap on every side
+
+        Without the right/bottom crop, neighbouring tiles both paint the seam and the
+        result depends on the order the decode pool finishes in.
+        """
+        with Image.open(io.BytesIO(tile_data)) as tile_image:
+            tile_image = tile_image.convert('RGB')
+        left = overlap if x > 0 else 0
+        top = overlap if y > 0 else 0
+        box = (left, top, min(left + tile_size, tile_image.width), min(top + tile_size, tile_image.height))
+        if box != (0, 0, tile_image.width, tile_image.height):
+            tile_image = tile_image.crop(box)
+        return tile_image
+
+    def report_progress(self, job):
+        """Print the job's tile progress together with the aggregate over all jobs"""
+        job_progress = (job.done_tiles / job.total_tiles) * 100 if job.total_tiles else 0
+        done_jobs = sum(1 for j in self._jobs if j.status in ('done', 'failed'))
+        done_tiles = sum(j.done_tiles for j in self._jobs)
+        known_tiles = sum(j.total_tiles for j in self._jobs)
+        print(f"URL {job.index + 1}: {job_progress:.1f}% | Jobs {done_jobs}/{len(self._jobs)} | "
+              f"Tiles {done_tiles}/{known_tiles}", end='\r')
+
+    async def download_level(self, session, job, level, executor):
         """Download and compose image for specific level"""
-        print(f"\nProcessing URL {url_index + 1}/{self.total_urls}")
-        print(f"Analyzing level {level}...")
+        print(f"\nAnalyzing level {level} for URL {job.index + 1}/{self.total_urls}...")
 
-        tiles_x, tiles_y = await self.get_level_dimensions(session, level)
+        tiles_x, tiles_y = await self.get_level_dimensions(session, job, level)
 
         if tiles_x == 0 or tiles_y == 0:
-            print(f"No tiles found at level {level}")
+            print(f"No tiles found at level {level} for URL {job.index + 1}")
             return False
 
-        # Create canvas with transparent background
-        canvas = Image.new('RGBA', (tiles_x * self.tile_size, tiles_y * self.tile_size), (0, 0, 0, 0))
-
-        print(f"Downloading {tiles_x * tiles_y} tiles...")
-        total_tiles = tiles_x * tiles_y
-        downloaded_tiles = 0
-
-        for y in range(tiles_y):
-            for x in range(tiles_x):
-                tile_data = await self.download_tile(session, x, y, level)
-                if tile_data:
-                    try:
-                        tile_image = Image.open(io.BytesIO(tile_data))
-                        if tile_image.mode != 'RGBA':
-                            tile_image = tile_image.convert('RGBA')
-                        canvas.paste(tile_image, (x * self.tile_size, y * self.tile_size))
-
-                        downloaded_tiles += 1
-                        tile_progress = (downloaded_tiles / total_tiles) * 100
-                        total_progress = ((url_index + tile_progress / 100) / self.total_urls) * 100
-                        print(f"Current image: {tile_progress:.1f}% | Overall progress: {total_progress:.1f}%",
-                              end='\r')
-                    except Exception as e:
-                        print(f"\nError processing tile {x},{y}: {e}")
-
-        print("\nProcessing final image...")
-        canvas = canvas.convert('RGB')
-        canvas = self.precise_crop(canvas)
+        descriptor = await self.fetch_descriptor(session, job)
+        overlap = descriptor['overlap'] if descriptor else 0
+        if descriptor:
+            # Set on every job, not only the one that filled the grid cache
+            job.tile_size = descriptor['tile_size']
+            canvas_size = self.level_size(descriptor, level)
+        else:
+            canvas_size = (tiles_x * job.tile_size, tiles_y * job.tile_size)
+        canvas = Image.new('RGB', canvas_size)
+
+        job.total_tiles = tiles_x * tiles_y
+        print(f"\nURL {job.index + 1}: downloading {job.total_tiles} tiles...")
+
+        # Fetchers feed a bounded queue; decoders turn bytes into cropped RGB tiles off the event loop
+        queue = asyncio.Queue(maxsize=self.max_concurrent_fetches * 2)
+        fetch_slots = asyncio.Semaphore(self.max_concurrent_fetches)
+        loop = asyncio.get_running_loop()
+
+        async def fetch(x, y):
+            async with fetch_slots:
+                tile_data = await self.download_tile(session, job, x, y, level)
+            if tile_data:
+                await queue.put((x, y, tile_data))
+
+        async def decode_and_paste():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    queue.task_done()
+                    return
+                x, y, tile_data = item
+                try:
+                    tile_image = await loop.run_in_executor(executor, self.decode_tile, tile_data, x, y, overlap,
+                                                            job.tile_size)
+                    canvas.paste(tile_image, (x * job.tile_size, y * job.tile_size))
+                    job.done_tiles += 1
+                    self.report_progress(job)
+                except Exception as e:
+                    print(f"\nError processing tile {x},{y} of URL {job.index + 1}: {e}")
+                finally:
+                    queue.task_done()
+
+        consumers = [asyncio.create_task(decode_and_paste()) for _ in range(self.decode_workers)]
+        await asyncio.gather(*(fetch(x, y) for y in range(tiles_y) for x in range(tiles_x)))
+        for _ in consumers:
+            await queue.put(None)
+        await asyncio.gather(*consumers)
+
+        # Cropping and encoding are CPU-bound; keep them off the loop so other jobs keep downloading
+        print(f"\nURL {job.index + 1}: processing final image...")
+        canvas = await loop.run_in_executor(executor, self.precise_crop, canvas)
 
         # Create output directory with URL index
-        url_output_dir = os.path.join(self.output_dir, f"url_{url_index + 1}")
+        url_output_dir = os.path.join(self.output_dir, f"url_{job.index + 1}")
         os.makedirs(url_output_dir, exist_ok=True)
 
-        print("Saving image...")
         output_path = os.path.join(url_output_dir, f"final_image_level_{level}.jpg")
-        canvas.save(output_path, "JPEG", quality=95)
-        print(f"Saved final image to {output_path}")
-
-        print(f"Final image dimensions: {canvas.size[0]}x{canvas.size[1]} pixels")
+        await loop.run_in_executor(executor, lambda: canvas.save(output_path, "JPEG", quality=95))
+        print(f"\nSaved final image to {output_path} ({canvas.size[0]}x{canvas.size[1]} pixels)")
         return True
 
+    async def process_job(self, session, job, level, executor, job_slots):
+        """Run one image end to end under the batch-wide job limit"""
+        async with job_slots:
+            job.status = 'running'
+            print(f"\nProcessing URL {job.index + 1}/{self.total_urls}: {job.url}")
+            try:
+                if await self.test_level_validity(session, job, level):
+                    ok = await self.download_level(session, job, level, executor)
+                else:
+                    print(f"\nNo valid image found at level {level} for URL: {job.url}")
+                    ok = False
+            except Exception as e:
+                print(f"\nURL {job.index + 1} failed: {e}")
+                ok = False
+            job.status = 'done' if ok else 'failed'
+            self.report_progress(job)
+
     async def get_valid_level(self, session):
         """Get a valid level from user input with retry logic"""
         while True:
@@ -226,7 +417,8 @@ class ImageDownloader:  #用于下载故宫博物院后缀我xml的缩放图
                 print("Please enter either 1 or 2.")
 
             # Get level input
-            async with aiohttp.ClientSession(headers=self.headers) as session:
+            connector = aiohttp.TCPConnector(limit_per_host=self.max_requests_per_host)
+            async with aiohttp.ClientSession(headers=self.headers, connector=connector) as session:
                 level = await self.get_valid_level(session)
 
                 if choice == '1':
@@ -248,23 +440,25 @@ class ImageDownloader:  #用于下载故宫博物院后缀我xml的缩放图
                         except ValueError:
                             print("Please enter a valid number.")
 
-                # Process selected URLs
+                # Build one job per selected URL; each job carries its own state
+                self._jobs = []
                 for i in url_range:
                     url = urls[i]
                     url_info = self.extract_url_info(url)
                     if not url_info:
                         print(f"\nInvalid URL format for URL {i + 1}: {url}")
                         continue
+                    self._jobs.append(DownloadJob(i, url, url_info, self.tile_size))
 
-                    self.current_url_info = url_info
-                    self.current_url_index = i
-                    print(f"\nProcessing URL {i + 1}/{self.total_urls}: {url}")
+                # Several images run at once; tile requests share the per-host budget
+                job_slots = asyncio.Semaphore(self.max_concurrent_jobs)
+                with ThreadPoolExecutor(max_workers=self.decode_workers) as executor:
+                    await asyncio.gather(*(
+                        self.process_job(session, job, level, executor, job_slots) for job in self._jobs
+                    ))
 
-                    print("Testing level validity...")
-                    if await self.test_level_validity(session, level):
-                        await self.download_level(session, level, i)
-                    else:
-                        print(f"No valid image found at level {level} for URL: {url}")
+                done = sum(1 for job in self._jobs if job.status == 'done')
+                print(f"\n{done}/{len(self._jobs)} images completed")
 
             print("\nBatch download completed!")
 
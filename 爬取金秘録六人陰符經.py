@@ -1,17 +1,13 @@
 import requests
-from PIL import Image
-from fpdf import FPDF
 import os
-import time
+import concurrent.futures
 
-# Base URL template with a placeholder for the page number
-base_url_template = "https://rmda.kulib.kyoto-u.ac.jp/iiif/3/RB00023187%2FRB00023187_{page_num:05}_0.ptif/full/3017,/0/default.jpg"
-
-# Number of pages
-total_pages = 19
+from image_pdf import images_to_pdf
+from rate_limiter import HostRateLimiter
+from retry_policy import RetryPolicy, request_with_retry
 
-# List to store downloaded image filenames
-image_files = []
+# Base URL template with a placeholder for the page number
+BASE_URL_TEMPLATE = "https://rmda.kulib.kyoto-u.ac.jp/iiif/3/RB00023187%2FRB00023187_{page_num:05}_0.ptif/full/3017,/0/default.jpg"
 
 # Enhanced headers to better mimic a real browser
 headers = {
@@ -24,55 +20,84 @@ headers = {
     'DNT': '1',
 }
 
-# Create a session to persist cookies and headers across requests
-session = requests.Session()
-session.headers.update(headers)
+# 403 在该站点通常是临时的反爬限制，按退避策略重试而不是直接放弃
+retry_policy = RetryPolicy(retry_statuses=(403, 408, 429, 500, 502, 503, 504))
 
-# Step 1: 下载所有图片
-for page in range(1, total_pages + 1):
-    page_num_str = f"{page:05}"  # Format the page number as a zero-padded 5-digit string
-    img_url = base_url_template.format(page_num=page_num_str)
-    try:
-        response = session.get(img_url, proxies={"http": None, "https": None})
-
-        if response.status_code == 200:  # 检查响应状态
-            img_filename = f"image_{page:03}.jpg"
-            with open(img_filename, 'wb') as handler:
-                handler.write(response.content)
-                image_files.append(img_filename)
-                print(f"Page {page} downloaded successfully.")
-        elif response.status_code == 403:
-            print(f"Failed to download page {page}: HTTP 403 - Access Forbidden")
-            break
-        else:
-            print(f"Failed to download page {page}: HTTP {response.status_code}")
-            break
 
-        # 增加请求间隔，避免被反爬虫机制识别
-        time.sleep(2)  # 间隔2秒
+def download_page(session, limiter, base_url_template, page):
+    """下载单页，成功返回文件名，失败返回 None"""
+    img_url = base_url_template.format(page_num=page)
+    try:
+        # 限速器控制每秒请求数和同时进行的请求数，取代固定的 time.sleep(2)；
+        # 每次重试都重新取令牌，退避等待期间不占用并发名额
+        response = request_with_retry(session, img_url, retry_policy, timeout=(10, 120),
+                                      proxies={"http": None, "https": None},
+                                      attempt_slot=lambda: limiter.limit(img_url))
     except requests.exceptions.RequestException as e:
         print(f"Error downloading page {page}: {e}")
-        break
-
-# Step 2: 将图片合并为一个PDF
-if image_files:
-    pdf = FPDF()
-    for image_file in image_files:
-        try:
-            with Image.open(image_file) as image:
-                pdf.add_page()
-                pdf.image(image_file, 0, 0, 210, 297)  # 以A4大小插入图片
-        except (IOError, UnidentifiedImageError) as e:
-            print(f"Error processing file {image_file}: {e}")
-            continue
-
-    output_pdf = "output.pdf"
-    pdf.output(output_pdf)
-
-    # Step 3: 清理下载的图片文件
-    for image_file in image_files:
-        os.remove(image_file)
-
-    print(f"PDF 文件已生成: {output_pdf}")
-else:
-    print("没有成功下载任何图片，未生成 PDF 文件。")
+        return None
+
+    if response.status_code != 200:  # 检查响应状态
+        print(f"Failed to download page {page}: HTTP {response.status_code}")
+        return None
+
+    img_filename = f"image_{page:03}.jpg"
+    with open(img_filename, 'wb') as handler:
+        handler.write(response.content)
+    print(f"Page {page} downloaded successfully.")
+    return img_filename
+
+
+def download_book(base_url_template=BASE_URL_TEMPLATE, total_pages=19, output_pdf="output.pdf",
+                  rate=0.5, max_in_flight=3, max_rounds=3):
+    """
+    下载整本书并合并为 PDF
+
+    :param rate: 每秒请求数（0.5 相当于原来每 2 秒一次）
+    :param max_in_flight: 同时进行的请求数
+    :param max_rounds: 失败页面最多重新下载的轮数
+    """
+    limiter = HostRateLimiter(rate=rate, burst=max_in_flight, max_in_flight=max_in_flight)
+
+    # Create a session to persist cookies and headers across requests
+    session = requests.Session()
+    session.headers.update(headers)
+
+    # Step 1: 下载所有图片，失败的页面跳过，留到下一轮重试
+    page_files = {}
+    pending = list(range(1, total_pages + 1))
+    for round_index in range(max_rounds):
+        if not pending:
+            break
+        if round_index:
+            print(f"Retrying {len(pending)} failed pages (round {round_index + 1}/{max_rounds})...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            futures = {executor.submit(download_page, session, limiter, base_url_template, page): page
+                       for page in pending}
+            for future in concurrent.futures.as_completed(futures):
+                if future.result():
+                    page_files[futures[future]] = future.result()
+        pending = [page for page in pending if page not in page_files]
+
+    if pending:
+        print(f"Pages skipped after {max_rounds} rounds: {pending}")
+
+    image_files = [page_files[page] for page in sorted(page_files)]
+
+    # Step 2: 将图片合并为一个PDF
+    if image_files:
+        # JPEG 直接嵌入，按比例缩放到 A4 页面
+        images_to_pdf(image_files, output_pdf, fit="a4")
+
+        # Step 3: 清理下载的图片文件
+        for image_file in image_files:
+            os.remove(image_file)
+
+        print(f"PDF 文件已生成: {output_pdf}")
+    else:
+        print("没有成功下载任何图片，未生成 PDF 文件。")
+    return pending
+
+
+if __name__ == "__main__":
+    download_book(BASE_URL_TEMPLATE, total_pages=19)
@@ -1,27 +1,131 @@
 import os
+import json
 import math
+import time
+import threading
 import requests
 import concurrent.futures
+from contextlib import contextmanager
 from PIL import Image
 from tqdm import tqdm
 
+from retry_policy import RetryPolicy, request_with_retry
+
+
+class AIMDController:
+    def __init__(self, initial, minimum=1, maximum=64, window=20, error_threshold=0.05, latency_factor=1.5):
+        """
+        Additive-increase / multiplicative-decrease limit on in-flight requests
+
+        :param initial: Starting concurrency
+        :param minimum: Lowest concurrency the controller backs off to
+        :param maximum: Highest concurrency the controller grows to
+        :param window: Completed requests per evaluation window
+        :param error_threshold: Error rate above which the window counts as unhealthy
+        :param latency_factor: Allowed p95 growth over the healthy baseline
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.error_threshold = error_threshold
+        self.latency_factor = latency_factor
+
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._latencies = []
+        self._errors = 0
+        self._baseline_p95 = None
+        self._limit_samples = []
+
+    def acquire(self):
+        """Block until a request slot is available under the current limit"""
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+            self._limit_samples.append(int(self.limit))
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """Hold one request slot for the duration of a single attempt"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record(self, latency, ok, throttled):
+        """Record the outcome of one attempt and adjust the limit"""
+        with self._condition:
+            if throttled:
+                # Back off immediately on 429/5xx instead of waiting for the window
+                self.limit = max(self.minimum, self.limit / 2)
+                self._latencies.clear()
+                self._errors = 0
+            else:
+                self._latencies.append(latency)
+                self._errors += 0 if ok else 1
+                if len(self._latencies) >= self.window:
+                    self._evaluate()
+            self._condition.notify_all()
+
+    def _evaluate(self):
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        error_rate = self._errors / len(latencies)
+        if self._baseline_p95 is None:
+            self._baseline_p95 = p95
+
+        if error_rate > self.error_threshold or p95 > self._baseline_p95 * self.latency_factor:
+            self.limit = max(self.minimum, self.limit / 2)
+        else:
+            self.limit = min(self.maximum, self.limit + 1)
+            self._baseline_p95 = 0.8 * self._baseline_p95 + 0.2 * p95
+
+        self._latencies.clear()
+        self._errors = 0
+
+    @property
+    def average_limit(self):
+        return sum(self._limit_samples) / len(self._limit_samples) if self._limit_samples else self.limit
+
 
 class IIIFDownloader:
-    def __init__(self, base_url, image_width, image_height, tile_size=256, max_workers=10):
+    def __init__(self, base_url, image_width=None, image_height=None, tile_size=None, max_workers=10,
+                 min_workers=2, max_region_size=1024, verify_decode=False):
         """
-        Initialize IIIF image downloader with multi-threading support
+        Initialize IIIF image downloader with adaptive multi-threading support
 
         :param base_url: Base IIIF image URL
-        :param image_width: Total image width
-        :param image_height: Total image height
-        :param tile_size: Size of each tile (default 256)
-        :param max_workers: Maximum number of concurrent download threads
+        :param image_width: Total image width (read from info.json when omitted)
+        :param image_height: Total image height (read from info.json when omitted)
+        :param tile_size: Region size to request (chosen from info.json when omitted)
+        :param max_workers: Upper bound for concurrent download threads
+        :param min_workers: Lower bound the adaptive controller backs off to
+        :param max_region_size: Largest region edge to request when the server sets no limit
+        :param verify_decode: Also parse each existing tile's image header when resuming
         """
         self.base_url = base_url
         self.image_width = image_width
         self.image_height = image_height
         self.tile_size = tile_size
         self.max_workers = max_workers
+        self.min_workers = min_workers
+        self.max_region_size = max_region_size
+        self.verify_decode = verify_decode
+        self.retry_policy = RetryPolicy()
+        self.controller = self._new_controller()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._bytes_downloaded = 0
+        self._expected_sizes = {}
+        self.sizes_save_interval = 50
 
         # Proxy configuration (optional)
         self.proxies = {
@@ -33,6 +137,49 @@ class IIIFDownloader:
         self.output_dir = "tiles"
         os.makedirs(self.output_dir, exist_ok=True)
 
+        if self.image_width is None or self.image_height is None or self.tile_size is None:
+            self.load_info()
+
+    def load_info(self):
+        """
+        Read info.json for the image size, advertised tiles and server size limits,
+        then pick the largest region size the server allows
+        """
+        response = request_with_retry(self._session(), f"{self.base_url}/info.json", self.retry_policy,
+                                      timeout=15, headers={'Accept': 'application/json'})
+        response.raise_for_status()
+        info = response.json()
+
+        self.image_width = self.image_width or int(info['width'])
+        self.image_height = self.image_height or int(info['height'])
+
+        # v3 puts the limits at the top level, v2 inside the profile description
+        limits = dict(info)
+        profile = info.get('profile')
+        if isinstance(profile, list):
+            for entry in profile:
+                if isinstance(entry, dict):
+                    limits.update(entry)
+
+        if self.tile_size is None:
+            advertised = [int(tile['width']) for tile in info.get('tiles', []) if 'width' in tile]
+            base_tile = max(advertised) if advertised else 256
+
+            region = self.max_region_size
+            if 'maxWidth' in limits:
+                region = min(region, int(limits['maxWidth']))
+            if 'maxHeight' in limits:
+                region = min(region, int(limits['maxHeight']))
+            if 'maxArea' in limits:
+                region = min(region, math.isqrt(int(limits['maxArea'])))
+
+            # Keep regions on the server's tile grid so cached tiles can be reused
+            if region >= base_tile:
+                region = region // base_tile * base_tile
+            self.tile_size = max(region, 1)
+
+        print(f"Image: {self.image_width}x{self.image_height}, region size: {self.tile_size}px")
+
     def _generate_tile_url(self, x, y):
         """Generate tile URL for specific region"""
         region_x = x * self.tile_size
@@ -41,44 +188,152 @@ class IIIFDownloader:
         height = min(self.tile_size, self.image_height - region_y)
 
         return (
-            f"{self.base_url}/{region_x},{region_y},{width},{height}/256,/0/default.jpg",
+            f"{self.base_url}/{region_x},{region_y},{width},{height}/{width},{height}/0/default.jpg",
             os.path.join(self.output_dir, f"tile_{x}_{y}.jpg"),
             x, y
         )
 
-    def download_tile(self, tile_info, retries=3):
+    def _new_controller(self):
+        return AIMDController(
+            initial=max(self.min_workers, self.max_workers // 2),
+            minimum=self.min_workers,
+            maximum=self.max_workers
+        )
+
+    def _session(self):
+        """Per-thread keep-alive session"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.proxies.update(self.proxies)
+            session.headers.update({
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                'Accept': 'image/jpeg'
+            })
+            self._local.session = session
+        return session
+
+    def _tile_size_on_grid(self, x, y):
+        """Pixel size of the region for tile (x, y)"""
+        return (min(self.tile_size, self.image_width - x * self.tile_size),
+                min(self.tile_size, self.image_height - y * self.tile_size))
+
+    @property
+    def _sizes_path(self):
+        return os.path.join(self.output_dir, "tile_sizes.json")
+
+    def _load_expected_sizes(self):
+        """
+        Load the tile lengths recorded by an earlier run of the same image and region size
+
+        Tile names only encode the grid position, so tiles left by a different image or
+        region size (or with no record of where they came from) are deleted, not reused.
+        """
+        try:
+            with open(self._sizes_path, "r", encoding="utf-8") as f:
+                recorded = json.load(f)
+        except (FileNotFoundError, ValueError):
+            recorded = None
+
+        if (isinstance(recorded, dict) and recorded.get("base_url") == self.base_url
+                and recorded.get("tile_size") == self.tile_size):
+            self._expected_sizes = dict(recorded.get("sizes", {}))
+            return
+
+        self._expected_sizes = {}
+        stale = [name for name in os.listdir(self.output_dir)
+                 if name.startswith("tile_") and name.endswith((".jpg", ".part"))]
+        if stale:
+            print(f"Discarding {len(stale)} tiles from a different image or region size")
+            for name in stale:
+                os.remove(os.path.join(self.output_dir, name))
+
+    def _save_expected_sizes(self):
+        """Write the recorded tile lengths atomically; safe to call while workers are running"""
+        with self._stats_lock:
+            sizes = dict(self._expected_sizes)
+        temp_path = self._sizes_path + ".part"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"base_url": self.base_url, "tile_size": self.tile_size, "sizes": sizes}, f)
+        os.replace(temp_path, self._sizes_path)
+
+    def verify_tile(self, output_path, x, y):
+        """
+        Cheap integrity check for an existing tile
+
+        Checks the recorded byte length when known, the JPEG/PNG end marker,
+        and optionally that the image header reports the expected region size.
+        """
+        try:
+            size = os.path.getsize(output_path)
+        except OSError:
+            return False
+        if size == 0:
+            return False
+
+        expected = self._expected_sizes.get(os.path.basename(output_path))
+        if expected is not None and size != expected:
+            return False
+
+        with open(output_path, "rb") as f:
+            head = f.read(8)
+            f.seek(max(size - 32, 0))
+            tail = f.read()
+        if head.startswith(b"\xff\xd8"):
+            # JPEG must end with EOI; allow a little trailing padding
+            if not tail.rstrip(b"\x00").endswith(b"\xff\xd9"):
+                return False
+        elif head.startswith(b"\x89PNG\r\n\x1a\n"):
+            if not tail.endswith(b"IEND\xaeB`\x82"):
+                return False
+        else:
+            return False
+
+        if self.verify_decode:
+            try:
+                with Image.open(output_path) as tile:
+                    if tile.size != self._tile_size_on_grid(x, y):
+                        return False
+            except (OSError, SyntaxError):
+                return False
+        return True
+
+    def download_tile(self, tile_info):
         """
-        Download a single tile with retry mechanism
+        Download a single tile using the shared retry/backoff policy
 
         :param tile_info: Tuple containing (tile_url, output_path, x, y)
-        :param retries: Number of download retries
         :return: Success status and tile information
         """
         tile_url, output_path, x, y = tile_info
 
-        # Skip if tile already exists
-        if os.path.exists(output_path):
+        # Skip only tiles that pass the integrity check; truncated ones are fetched again
+        if os.path.exists(output_path) and self.verify_tile(output_path, x, y):
             return True, (tile_url, output_path, x, y)
 
-        for attempt in range(retries):
-            try:
-                response = requests.get(
-                    tile_url,
-                    proxies=self.proxies,
-                    timeout=15,
-                    headers={
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                        'Accept': 'image/jpeg'
-                    }
-                )
-
-                if response.status_code == 200:
-                    with open(output_path, "wb") as f:
-                        f.write(response.content)
-                    return True, (tile_url, output_path, x, y)
-
-            except requests.exceptions.RequestException as e:
-                print(f"Download error for tile {x},{y}: {e}")
+        def record_attempt(status, latency):
+            # Every attempt, including ones the retry policy gets past, feeds the controller
+            throttled = status is None or status == 429 or status >= 500
+            self.controller.record(latency, status == 200, throttled)
+
+        try:
+            # The controller slot is held per attempt, never during backoff sleeps
+            response = request_with_retry(self._session(), tile_url, self.retry_policy, timeout=15,
+                                          attempt_slot=self.controller.slot, on_attempt=record_attempt)
+
+            if response.status_code == 200:
+                # Write to a temporary file first so a killed run never leaves a partial tile
+                temp_path = output_path + ".part"
+                with open(temp_path, "wb") as f:
+                    f.write(response.content)
+                os.replace(temp_path, output_path)
+                with self._stats_lock:
+                    self._expected_sizes[os.path.basename(output_path)] = len(response.content)
+                    self._bytes_downloaded += len(response.content)
+                return True, (tile_url, output_path, x, y)
+
+        except requests.exceptions.RequestException as e:
+            print(f"Download error for tile {x},{y}: {e}")
 
         return False, (tile_url, output_path, x, y)
 
@@ -101,26 +356,40 @@ class IIIFDownloader:
         successful_tiles = []
         failed_tiles = []
 
-        # Multi-threaded download
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_tile = {executor.submit(self.download_tile, tile): tile for tile in tile_urls}
-
-            for future in concurrent.futures.as_completed(future_to_tile):
-                success, tile_info = future.result()
-                progress_bar.update(1)
-
-                if success:
-                    successful_tiles.append(tile_info)
-                else:
-                    failed_tiles.append(tile_info)
-
-        progress_bar.close()
+        # Threads are capped at max_workers; the controller decides how many may be in flight
+        self.controller = self._new_controller()
+        self._bytes_downloaded = 0
+        started = time.monotonic()
+        self._load_expected_sizes()
+
+        # Multi-threaded download; tile lengths are saved as the run goes, so a killed run keeps them
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                future_to_tile = {executor.submit(self.download_tile, tile): tile for tile in tile_urls}
+
+                for done, future in enumerate(concurrent.futures.as_completed(future_to_tile), 1):
+                    success, tile_info = future.result()
+                    progress_bar.update(1)
+
+                    if success:
+                        successful_tiles.append(tile_info)
+                    else:
+                        failed_tiles.append(tile_info)
+                    if done % self.sizes_save_interval == 0:
+                        self._save_expected_sizes()
+        finally:
+            progress_bar.close()
+            self._save_expected_sizes()
+        elapsed = max(time.monotonic() - started, 1e-6)
 
         # Report download results
         print(f"\nDownload Summary:")
         print(f"Total Tiles: {len(tile_urls)}")
         print(f"Successful Downloads: {len(successful_tiles)}")
         print(f"Failed Downloads: {len(failed_tiles)}")
+        print(f"Concurrency: final {int(self.controller.limit)}, average {self.controller.average_limit:.1f}")
+        print(f"Throughput: {len(successful_tiles) / elapsed:.1f} tiles/s, "
+              f"{self._bytes_downloaded / elapsed / 1024 / 1024:.2f} MB/s")
 
         return successful_tiles, failed_tiles
 
@@ -135,15 +404,19 @@ class IIIFDownloader:
         # Create output image
         full_image = Image.new("RGB", (self.image_width, self.image_height), color=(240, 240, 255))
 
-        # Stitch tiles
-        for x in range(tiles_x):
-            for y in range(tiles_y):
-                tile_path = os.path.join(self.output_dir, f"tile_{x}_{y}.jpg")
-
-                if os.path.exists(tile_path):
-                    tile = Image.open(tile_path)
+        def paste_tile(x, y):
+            tile_path = os.path.join(self.output_dir, f"tile_{x}_{y}.jpg")
+            if os.path.exists(tile_path):
+                with Image.open(tile_path) as tile:
                     full_image.paste(tile, (x * self.tile_size, y * self.tile_size))
 
+        # Stitch tiles: decode in parallel (Pillow releases the GIL), each tile into its own region;
+        # open file handles are bounded by the worker count
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(paste_tile, x, y) for x in range(tiles_x) for y in range(tiles_y)]
+            for future in futures:
+                future.result()
+
         # Save stitched image with a Windows-inspired filename
         output_filename = "ArchivalImage_Stitched.jpg"
         full_image.save(output_filename, quality=95)
@@ -151,17 +424,13 @@ class IIIFDownloader:
 
 
 def main():
-    # IIIF Image Configuration
+    # IIIF Image Configuration; size and region limits come from info.json
     base_url = "https://www.artic.edu/iiif/2/3a608f55-d76e-fa96-d0b1-0789fbc48f1e"
-    image_width = 19848
-    image_height = 24629
 
     # Create downloader instance
     downloader = IIIFDownloader(
         base_url=base_url,
-        image_width=image_width,
-        image_height=image_height,
-        max_workers=20  # Adjust based on your network capacity
+        max_workers=20  # Upper bound; the actual concurrency adapts to the server
     )
 
     # Download tiles
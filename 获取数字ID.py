@@ -1,37 +1,91 @@
-from playwright.sync_api import sync_playwright
+import hashlib
+import json
+import os
 import re
-#1.0 输入一个可解析的json，提取相应的id，更快速准确的下载图片
+import requests
 
-def extract_ids_from_manifest(manifest_url):
-    ids = []
+try:
+    import ijson  # 可选：安装后边下载边解析，不必等整个 JSON 读完
+except ImportError:
+    ijson = None
+#1.1 直接通过 HTTP 读取 IIIF manifest（支持 Presentation v2/v3），不再启动浏览器，结果按 URL + ETag 缓存
 
-    with sync_playwright() as p:
-        # 使用 Playwright 的浏览器上下文来访问 URL 并解析 JSON
-        browser = p.chromium.launch()
-        page = browser.new_page()
-        page.goto(manifest_url)
+CACHE_DIR = ".manifest_cache"
 
-        # 解析并获取 JSON 内容
-        manifest_content = page.evaluate("() => document.body.innerText")
-        browser.close()
+# v2: sequences[].canvases[].images[].resource.service.@id
+# v3: items[] (Canvas).items[] (AnnotationPage).items[] (Annotation).body.service[].id
+SERVICE_ID_PREFIXES = [
+    re.compile(r"^sequences\.item\.canvases\.item\.images\.item\.resource\.service(\.item)?\.@id$"),
+    re.compile(r"^items\.item\.items\.item\.items\.item\.body\.service(\.item)?\.(@id|id)$"),
+]
 
-        # 解析 JSON 内容并提取需要的部分
-        data = eval(manifest_content)  # 转换为 Python 字典
 
-        # 迭代所有的 "sequences" -> "canvases"
-        canvases = data['sequences'][0]['canvases']
+def _walk_service_ids(data):
+    """在已完整解析的 manifest 中按顺序找出图像服务 ID（未安装 ijson 时使用）"""
+    def service_ids(service):
+        for entry in service if isinstance(service, list) else [service]:
+            if isinstance(entry, dict) and (entry.get("@id") or entry.get("id")):
+                yield entry.get("@id") or entry.get("id")
 
-        for canvas in canvases:
-            # 检查是否包含目标 "label"
-            label = canvas.get('label', '')
-            if label.startswith("(seq."):
-                # 获取 `thumbnail` URL
-                thumbnail_url = canvas['thumbnail']['@id']
+    for sequence in data.get("sequences", []):
+        for canvas in sequence.get("canvases", []):
+            for image in canvas.get("images", []):
+                yield from service_ids(image.get("resource", {}).get("service", []))
 
-                # 使用正则表达式提取 `id`（例如：53240111）
-                match = re.search(r'iiif/(\d+)/full', thumbnail_url)
-                if match:
-                    ids.append(match.group(1))
+    for canvas in data.get("items", []):
+        for page in canvas.get("items", []):
+            for annotation in page.get("items", []):
+                body = annotation.get("body", {})
+                if isinstance(body, dict):
+                    yield from service_ids(body.get("service", []))
+
+
+def iter_service_ids(stream):
+    """边读边解析 manifest，按出现顺序逐个产出图像服务 ID"""
+    if ijson is None:
+        yield from _walk_service_ids(json.load(stream))
+        return
+
+    for prefix, event, value in ijson.parse(stream):
+        if event == "string" and any(pattern.match(prefix) for pattern in SERVICE_ID_PREFIXES):
+            yield value
+
+
+def service_id_to_id(service_id):
+    """服务地址的最后一段即数字 ID，例如 .../iiif/53240111 -> 53240111"""
+    return service_id.rstrip("/").rsplit("/", 1)[-1]
+
+
+def _cache_path(manifest_url):
+    return os.path.join(CACHE_DIR, hashlib.sha1(manifest_url.encode("utf-8")).hexdigest() + ".json")
+
+
+def extract_ids_from_manifest(manifest_url, use_cache=True):
+    cache_path = _cache_path(manifest_url)
+    cached = None
+    if use_cache and os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+
+    with requests.get(manifest_url, headers=headers, stream=True, timeout=(10, 60)) as response:
+        # 内容未变化，直接使用缓存
+        if response.status_code == 304 and cached:
+            print(f"manifest 未变化，使用缓存：{cache_path}")
+            return cached["ids"]
+        response.raise_for_status()
+
+        response.raw.decode_content = True
+        ids = [service_id_to_id(service_id) for service_id in iter_service_ids(response.raw)]
+        etag = response.headers.get("ETag")
+
+    if use_cache and etag:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({"url": manifest_url, "etag": etag, "ids": ids}, f)
 
     return ids
 
@@ -44,9 +98,10 @@ def save_ids_to_txt(ids, filename="ids.txt"):
     print(f"已将 {len(ids)} 个 ID 写入 {filename} 文件中。")
 
 
-# 测试解析代码
-manifest_url = "https://iiif.lib.harvard.edu/manifests/drs:53239452"
-extracted_ids = extract_ids_from_manifest(manifest_url)
+if __name__ == "__main__":
+    # 测试解析代码
+    manifest_url = "https://iiif.lib.harvard.edu/manifests/drs:53239452"
+    extracted_ids = extract_ids_from_manifest(manifest_url)
 
-# 将提取到的 ID 写入 txt 文件
-save_ids_to_txt(extracted_ids)
+    # 将提取到的 ID 写入 txt 文件
+    save_ids_to_txt(extracted_ids)